@@ -0,0 +1,253 @@
+"""
+Backfill module
+Fetch the message history of channels in background tasks sharing a discord request budget
+"""
+import asyncio
+import itertools
+import logging
+import time
+from typing import Awaitable, Dict, Iterable, List, Optional, Set
+
+import discord
+
+from db import Db, message_record
+from metrics import BACKFILL_CHANNELS, BACKFILL_ROWS, BACKFILL_ROWS_PER_SECOND
+
+BACKFILL_BATCH_SIZE = 1000  # messages merged per database round trip
+HISTORY_PAGE_SIZE = 100  # messages per history request, the maximum of the discord API
+BACKFILL_CONCURRENCY = 4  # channels backfilled at the same time
+BACKFILL_REQUESTS_PER_SECOND = 20  # history requests shared by every channel
+PROGRESS_INTERVAL = 30  # seconds between progress logs
+BACKFILL_RETRIES = 3  # times a failed channel is queued again
+BACKFILL_RETRY_DELAY = 10  # seconds before a failed channel is queued again, times the attempt
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillMergeError(Exception):
+    """A batch of history could not be merged, the channel is retried from its checkpoint"""
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second on average, with bursts of `burst`"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait for a token"""
+
+        # Waiters are served in order, the lock is held while the first one sleeps
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def backfill_priority(channel: discord.TextChannel, checkpoint: int) -> tuple:
+    """
+    Sort key of a channel, smallest first
+
+    The time span between the checkpoint, or the creation of the channel, and the last
+    message stands for the number of messages to fetch. Channels with the same span are
+    sorted by their last message, the most recent first.
+    """
+
+    last_message_id = channel.last_message_id
+    if last_message_id is None:
+        return float('inf'), 0
+
+    first = checkpoint or channel.id
+    return (discord.utils.snowflake_time(last_message_id)
+            - discord.utils.snowflake_time(first)).total_seconds(), -last_message_id
+
+
+class BackfillScheduler:
+    """
+    Backfill channels with a bounded number of background tasks
+
+    Channels are queued by priority and picked by `concurrency` workers. Every history
+    request takes a token of a bucket shared by the workers, so the startup sync is bounded
+    by the request budget rather than by the size of the largest channel.
+    """
+
+    def __init__(self, db: Db, concurrency: int, requests_per_second: float):
+        self.db = db
+        self.concurrency = concurrency
+        self.budget = TokenBucket(requests_per_second, requests_per_second)
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()  # ties of priority are served in scheduling order
+        self.channels: Set[int] = set()  # queued or running
+        self.failures: Dict[int, int] = {}  # failed attempts of the queued channels
+        self.workers: List[asyncio.Task] = []
+        self.reporter: Optional[asyncio.Task] = None
+
+        self.running = 0
+        self.done = 0
+        self.rows = 0
+        self.start_time = 0.0
+
+    async def schedule(self, channels: Iterable[discord.TextChannel]) -> None:
+        """Queue the backfill of channels that are not already queued, without waiting for it"""
+
+        for channel in channels:
+            if channel.id in self.channels:
+                continue
+            if not channel.permissions_for(channel.guild.me).read_message_history:
+                continue
+
+            checkpoint = await self.db.get_channel_checkpoint(channel)
+            if checkpoint is None:
+                # Without its checkpoint the whole history of the channel would be fetched
+                logger.warning('Skipping backfill of channel %s, checkpoint unavailable',
+                               channel.id)
+                continue
+            if checkpoint and channel.last_message_id and channel.last_message_id <= checkpoint:
+                continue
+
+            self.channels.add(channel.id)
+            self.queue.put_nowait((backfill_priority(channel, checkpoint), next(self.order),
+                                   channel, checkpoint))
+
+        self._update_metrics()
+
+        if not self.workers:
+            self.start_time = time.perf_counter()
+            self.workers = [asyncio.ensure_future(self._work())
+                            for _ in range(self.concurrency)]
+            self.reporter = asyncio.ensure_future(self._report())
+
+    async def join(self) -> None:
+        """Wait until every queued channel is backfilled"""
+        await self.queue.join()
+
+    def close(self) -> None:
+        """Cancel the backfill, channels are resumed from their checkpoint next time"""
+
+        for task in self.workers + [self.reporter]:
+            if task:
+                task.cancel()
+        self.workers = []
+        self.reporter = None
+
+    async def _work(self) -> None:
+        while True:
+            priority, order, channel, checkpoint = await self.queue.get()
+            self.running += 1
+            self._update_metrics()
+            retry = False
+
+            try:
+                await self.backfill_channel(channel, checkpoint)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:  # pylint: disable=broad-except
+                # A failed channel must not stop the worker, it is resumed from its checkpoint
+                attempt = self.failures.get(channel.id, 0) + 1
+                retry = attempt <= BACKFILL_RETRIES
+                logger.error('%s %s, while backfilling channel %s, attempt %d%s',
+                             type(err).__name__, err, channel.id, attempt,
+                             ', retrying' if retry else '')
+                if retry:
+                    self.failures[channel.id] = attempt
+                    await asyncio.sleep(BACKFILL_RETRY_DELAY * attempt)
+                    # Resume after the batches merged before the failure
+                    checkpoint = await self.db.get_channel_checkpoint(channel) or checkpoint
+            finally:
+                self.running -= 1
+                if retry:
+                    self.queue.put_nowait((priority, order, channel, checkpoint))
+                else:
+                    self.done += 1
+                    self.channels.discard(channel.id)
+                    self.failures.pop(channel.id, None)
+                self._update_metrics()
+                self.queue.task_done()
+
+            if not self.running and self.queue.empty():
+                logger.info('Backfill complete: %d channels, %d messages in %.0f s', self.done,
+                            self.rows, time.perf_counter() - self.start_time)
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            if self.running or not self.queue.empty():
+                logger.info('Backfill: %d channels done, %d running, %d queued, %d messages '
+                            'in %.0f s', self.done, self.running, self.queue.qsize(), self.rows,
+                            time.perf_counter() - self.start_time)
+
+    def _update_metrics(self) -> None:
+        BACKFILL_CHANNELS.set(self.queue.qsize(), 'queued')
+        BACKFILL_CHANNELS.set(self.running, 'running')
+        BACKFILL_CHANNELS.set(self.done, 'done')
+
+    async def backfill_channel(self, channel: discord.TextChannel, checkpoint: int) -> None:
+        """
+        Fetch the messages of a channel after its checkpoint, 0 for its whole history, a page
+        per request token
+        """
+
+        # Messages of a channel are newer than the channel itself
+        after = discord.Object(id=checkpoint or channel.id)
+        logger.info('Backfill channel %s of guild %s after %s', channel.id, channel.guild.id,
+                    checkpoint)
+
+        # The previous batch is merged while the next one is fetched from discord, a failed
+        # merge stops the backfill so that the checkpoint never skips messages
+        merging = None
+        batch = []
+        batch_start = time.perf_counter()
+
+        while True:
+            await self.budget.acquire()
+            page = [message async for message in
+                    channel.history(limit=HISTORY_PAGE_SIZE, after=after, oldest_first=True)]
+            if not page:
+                break
+
+            after = page[-1]
+            batch.extend(message_record(message) for message in page)
+
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                if merging:
+                    await self.wait_merge(channel, *merging)
+                merge = asyncio.ensure_future(self.db.merge_message_records(batch,
+                                                                           checkpoint=True))
+                merging = (merge, len(batch), batch_start)
+                batch = []
+                batch_start = time.perf_counter()
+
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+
+        if merging:
+            await self.wait_merge(channel, *merging)
+        if batch:
+            await self.wait_merge(channel, self.db.merge_message_records(batch, checkpoint=True),
+                                  len(batch), batch_start)
+
+    async def wait_merge(self, channel: discord.TextChannel, merge: Awaitable[bool], n_rows: int,
+                         start: float) -> None:
+        """Wait for the merge of a batch and record it, raise BackfillMergeError if it failed"""
+
+        if not await merge:
+            raise BackfillMergeError(f'merge of {n_rows} messages failed')
+        self.record_rate(channel, n_rows, start)
+
+    def record_rate(self, channel: discord.TextChannel, n_rows: int, start: float) -> None:
+        """Update backfill metrics of a channel after a merged batch fetched since `start`"""
+
+        self.rows += n_rows
+        BACKFILL_ROWS.inc(channel.guild.id, channel.id, amount=n_rows)
+        BACKFILL_ROWS_PER_SECOND.set(n_rows / max(time.perf_counter() - start, 1e-6),
+                                     channel.guild.id, channel.id)
@@ -0,0 +1,397 @@
+"""
+Benchmark
+Drive the Scrapper listeners and Db methods with synthetic discord objects, without connecting
+to discord.
+
+By default the database is an in-process fake pool answering every query after a fixed
+latency. With --postgres, the database configured in ../config/config.yml is used instead:
+point it to a scratch database, the benchmark writes synthetic guilds to it.
+
+    python benchmark.py --messages 100000 --rate 2000 --members 1000 10000 100000
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import statistics
+import time
+import tracemalloc
+from typing import List, Optional
+
+import discord
+import yaml
+
+from backfill import TokenBucket
+from db import MERGE_MESSAGE_STAGING_SQL, OPEN_ACTIVITIES_SQL, Db
+from launcher import bot_options
+from scrapper import Scrapper
+
+FIRST_ID = 600000000000000000  # synthetic snowflakes start here
+ONLINE_RATIO = 0.1  # members cached by the low memory mode
+CHUNK_SIZE = 1000  # members per gateway member chunk
+MESSAGE_IDS = itertools.count(FIRST_ID)
+ACTIVITY_IDS = itertools.count(1)
+
+
+class FakeTransaction:
+    """Transaction of a fake connection"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeConnection:
+    """Connection answering every statement with no rows after a fixed latency"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def _round_trip(self):
+        await asyncio.sleep(self.latency)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction()
+
+    async def execute(self, *_):
+        await self._round_trip()
+
+    async def executemany(self, *_):
+        await self._round_trip()
+
+    async def copy_records_to_table(self, *_, **__):
+        await self._round_trip()
+
+    async def fetch(self, query, *args):
+        await self._round_trip()
+        if query == OPEN_ACTIVITIES_SQL:
+            guilds, members, *_, starts = args[:6]
+            return [{'guild': guild, 'member': member, 'id': next(ACTIVITY_IDS), 'start': start}
+                    for guild, member, start in zip(guilds, members, starts)]
+        return []
+
+    async def fetchrow(self, query, *_):
+        await self._round_trip()
+        if query == MERGE_MESSAGE_STAGING_SQL:
+            return 0, 0
+        return None, None
+
+    async def fetchval(self, *_):
+        await self._round_trip()
+
+
+class FakePool:
+    """Pool of fake connections with the size limit of an asyncpg pool"""
+
+    def __init__(self, size: int, latency: float):
+        self.size = size
+        self.connections = asyncio.Queue()
+        for _ in range(size):
+            self.connections.put_nowait(FakeConnection(latency))
+
+    async def acquire(self, timeout=None) -> FakeConnection:
+        return await asyncio.wait_for(self.connections.get(), timeout)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def get_idle_size(self) -> int:
+        return self.connections.qsize()
+
+    def get_max_size(self) -> int:
+        return self.size
+
+    async def release(self, conn: FakeConnection) -> None:
+        self.connections.put_nowait(conn)
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeObject:
+    """Snowflake with an id and a name"""
+
+    def __init__(self, object_id: int, name: str = ''):
+        self.id = object_id
+        self.name = name
+
+
+class FakeMember(FakeObject):
+    """Member with the attributes read by Scrapper and Db"""
+
+    def __init__(self, member_id: int, guild: 'FakeGuild'):
+        super().__init__(member_id, f'member {member_id}')
+        self.guild = guild
+        self.bot = False
+        self.nick = f'nick {member_id}' if member_id % 3 else None
+        self.status = discord.Status.online if member_id % 2 else discord.Status.idle
+        self.activity = discord.Game(f'game {member_id % 50}') if member_id % 4 else None
+
+
+class FakeChannel(FakeObject):
+    """Text channel with a synthetic history"""
+
+    def __init__(self, channel_id: int, guild: 'FakeGuild', n_messages: int):
+        super().__init__(channel_id, f'channel {channel_id}')
+        self.guild = guild
+        self.n_messages = n_messages
+        self.fetched = 0
+        self.last_message_id = None
+
+    def permissions_for(self, _):
+        return discord.Permissions.all()
+
+    async def history(self, limit: int, **_):
+        """Next page of the history, every message is fetched once"""
+
+        start = self.fetched
+        self.fetched = min(self.n_messages, start + limit)
+        for i in range(start, self.fetched):
+            yield fake_message(self, self.guild.members[i % len(self.guild.members)], i)
+
+
+class FakeGuild(FakeObject):
+    """
+    Guild with synthetic members and text channels
+
+    Only `n_cached` members are kept in memory, like the member cache of the library, the
+    others are created when fetched.
+    """
+
+    def __init__(self, guild_id: int, n_members: int, n_channels: int, n_messages: int,
+                 n_cached: Optional[int] = None):
+        super().__init__(guild_id, f'guild {guild_id}')
+        self.emojis = []
+        self.n_members = n_members
+        self.members = [FakeMember(FIRST_ID + i, self)
+                        for i in range(n_members if n_cached is None else max(n_cached, 1))]
+        self.me = self.members[0]
+        self.text_channels = [FakeChannel(guild_id + i + 1, self, n_messages)
+                              for i in range(n_channels)]
+
+    async def fetch_members(self, **_):
+        for i in range(self.n_members):
+            member = FakeMember(FIRST_ID + i, self)
+            # Members fetched from the API have no presence
+            member.status = discord.Status.offline
+            member.activity = None
+            yield member
+
+
+class FakeBot:
+    """Bot attributes used by the cogs"""
+
+    def __init__(self, db: Db, guilds: List[FakeGuild]):
+        self.db = db
+        self.guilds = guilds
+        self.user = FakeObject(1, 'benchmark')
+
+
+def fake_message(channel: FakeChannel, author: FakeMember, i: int) -> FakeObject:
+    """Message with the attributes saved by Db"""
+
+    message = FakeObject(next(MESSAGE_IDS))
+    message.guild = channel.guild
+    message.channel = channel
+    message.author = author
+    message.content = f'synthetic message {i} of channel {channel.name}'
+    message.created_at = discord.utils.snowflake_time(message.id)
+    return message
+
+
+def percentiles(latencies: List[float]) -> str:
+    """p50 and p99 of latencies, in milliseconds"""
+
+    if len(latencies) < 2:
+        return 'n/a'
+    quantiles = sorted(latencies)
+    p50 = statistics.median(quantiles)
+    p99 = quantiles[min(len(quantiles) - 1, int(len(quantiles) * 0.99))]
+    return f'p50 {p50 * 1000:.3f} ms, p99 {p99 * 1000:.3f} ms'
+
+
+async def bench_messages(scrapper: Scrapper, guild: FakeGuild, n_messages: int,
+                         rate: float) -> None:
+    """Send live messages to on_message at a fixed rate, or as fast as possible"""
+
+    loop = asyncio.get_event_loop()
+    channel = guild.text_channels[0]
+    latencies = []
+    start = loop.time()
+
+    for i in range(n_messages):
+        if rate:
+            delay = start + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        message = fake_message(channel, guild.members[i % len(guild.members)], i)
+        handler_start = time.perf_counter()
+        await scrapper.on_message(message)
+        latencies.append(time.perf_counter() - handler_start)
+
+    # Messages are only saved once the write-behind buffer is flushed
+    await scrapper.bot.db.message_buffer.close()
+    elapsed = loop.time() - start
+    scrapper.bot.db.message_buffer.start()
+
+    print(f'on_message: {n_messages} messages in {elapsed:.2f} s, '
+          f'{n_messages / elapsed:.0f} messages/s, handler {percentiles(latencies)}')
+
+
+async def bench_member_updates(scrapper: Scrapper, guild: FakeGuild, n_updates: int) -> None:
+    """Send member updates with a new activity to on_member_update"""
+
+    latencies = []
+
+    for i in range(n_updates):
+        member = guild.members[i % len(guild.members)]
+        member.activity = discord.Game(f'update {i}')
+        start = time.perf_counter()
+        await scrapper.on_member_update(member, member)
+        latencies.append(time.perf_counter() - start)
+
+    print(f'on_member_update: {n_updates} updates, handler {percentiles(latencies)}')
+
+
+async def bench_sync(scrapper: Scrapper, guild: FakeGuild) -> None:
+    """Time the startup sync of a guild, and its backfill"""
+
+    scrapper.bot.guilds = [guild]
+    start = time.perf_counter()
+    await scrapper.save_guilds_data()
+    elapsed = time.perf_counter() - start
+    await scrapper.backfill.join()
+    backfill_elapsed = time.perf_counter() - start
+
+    n_messages = sum(channel.n_messages for channel in guild.text_channels)
+    print(f'save_guilds_data: {len(guild.members)} members in {elapsed:.2f} s, '
+          f'{n_messages} history messages backfilled in {backfill_elapsed:.2f} s')
+
+
+def member_payload(member_id: int) -> dict:
+    """Member as sent by the gateway in GUILD_CREATE and member chunks"""
+
+    return {'user': {'id': str(member_id), 'username': f'member {member_id}',
+                     'discriminator': f'{member_id % 10000:04d}', 'avatar': None},
+            'nick': f'nick {member_id}' if member_id % 3 else None, 'roles': [],
+            'joined_at': '2020-01-01T00:00:00+00:00', 'deaf': False, 'mute': False}
+
+
+def presence_payload(guild_id: int, member_id: int) -> dict:
+    """PRESENCE_UPDATE of an online member"""
+
+    payload = member_payload(member_id)
+    payload.update(guild_id=str(guild_id), status='online',
+                   client_status={'desktop': 'online'},
+                   activities=[{'name': f'game {member_id % 50}', 'type': 0}])
+    return payload
+
+
+async def bench_memory(config: dict, n_members: int) -> None:
+    """
+    Compare the member cache of the library with the full and low memory options of the bot
+
+    The gateway payloads of a large guild go through a real ConnectionState: GUILD_CREATE with
+    the online members, their presence updates, then the member chunks when the cache keeps
+    every member. Only the memory still used once they are processed is reported.
+    """
+    # pylint: disable=protected-access
+
+    guild_id = FIRST_ID - n_members
+    online = [FIRST_ID + i for i in range(max(int(n_members * ONLINE_RATIO), 1))]
+    guild_payload = {'id': str(guild_id), 'name': f'guild {guild_id}', 'member_count': n_members,
+                     'members': [member_payload(member_id) for member_id in online],
+                     'presences': [presence_payload(guild_id, member_id) for member_id in online]}
+
+    for mode in ('full', 'low memory'):
+        mode_config = dict(config, bot=dict(config['bot'], low_memory=str(mode != 'full')))
+        tracemalloc.start()
+
+        state = discord.state.ConnectionState(
+            dispatch=lambda *args, **kwargs: None, handlers={}, hooks={}, syncer=None, http=None,
+            loop=asyncio.get_event_loop(), **bot_options(mode_config))
+        guild = state._add_guild_from_data(guild_payload)
+        for presence in guild_payload['presences']:
+            state.parse_presence_update(presence)
+
+        if state.member_cache_flags.joined:
+            request = discord.state.ChunkRequest(guild.id, state.loop, state._get_guild)
+            state._chunk_requests[request.nonce] = request
+            chunks = range(0, n_members, CHUNK_SIZE)
+            for index, first in enumerate(chunks):
+                state.parse_guild_members_chunk({
+                    'guild_id': str(guild.id), 'nonce': request.nonce, 'chunk_index': index,
+                    'chunk_count': len(chunks),
+                    'members': [member_payload(FIRST_ID + i)
+                                for i in range(first, min(n_members, first + CHUNK_SIZE))]})
+
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f'memory ({mode}): {len(guild.members)} cached members, '
+              f'{current / 2 ** 20:.1f} MiB in the library state')
+        del state, guild
+
+
+async def main(args: argparse.Namespace) -> None:
+    """Run every benchmark"""
+
+    with open('../config/config.yml', 'r') as config_file:
+        config = yaml.load(config_file, Loader=yaml.BaseLoader)
+
+    db = Db(config)
+    if args.postgres:
+        await db.connect_db()
+    else:
+        db.pool = FakePool(args.pool_size, args.latency / 1000)
+        db.message_buffer.start()
+
+    scrapper = Scrapper(FakeBot(db, []))
+    scrapper.backfill.budget = TokenBucket(args.requests_per_second, args.requests_per_second)
+
+    try:
+        for n_members in args.members:
+            guild = FakeGuild(FIRST_ID - n_members, n_members, args.channels, args.history)
+            print(f'--- guild of {n_members} members')
+            await bench_sync(scrapper, guild)
+            await bench_messages(scrapper, guild, args.messages, args.rate)
+            await bench_member_updates(scrapper, guild, args.updates)
+            if args.memory:
+                await bench_memory(config, n_members)
+    finally:
+        scrapper.backfill.close()
+        await db.close()
+
+
+def parse_args() -> argparse.Namespace:
+    """Benchmark options"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--postgres', action='store_true',
+                        help='use the database of config.yml instead of a fake pool')
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='round trip latency of the fake pool, in milliseconds')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='connections of the fake pool')
+    parser.add_argument('--members', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='member counts of the synthetic guilds')
+    parser.add_argument('--channels', type=int, default=5, help='text channels per guild')
+    parser.add_argument('--history', type=int, default=2000,
+                        help='history messages per channel')
+    parser.add_argument('--requests-per-second', type=float, default=1000,
+                        help='history requests per second of the backfill')
+    parser.add_argument('--messages', type=int, default=20000, help='live messages to send')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='live messages per second, 0 to send as fast as possible')
+    parser.add_argument('--updates', type=int, default=2000, help='member updates to send')
+    parser.add_argument('--memory', action='store_true',
+                        help='compare the member cache in full and low memory modes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(main(parse_args()))
@@ -0,0 +1,161 @@
+"""
+Query plan check
+Seed a small dataset, EXPLAIN every statement of the db module and fail if one of them
+sequentially scans a staticord table.
+
+Run it from the bot directory against a scratch database: the seeded rows are rolled back,
+but the statements are planned on the tables configured in ../config/config.yml
+"""
+import asyncio
+import datetime
+import json
+import logging
+import sys
+
+import yaml
+
+import db
+from db import Db
+
+NOW = datetime.datetime(2020, 1, 1)
+
+SEED_SQL = """
+INSERT INTO staticord.guild (id, name) VALUES (1, 'guild') ON CONFLICT DO NOTHING;
+INSERT INTO staticord.member (id, guild, name)
+    SELECT i, 1, 'member ' || i FROM generate_series(1, 100) AS i
+ON CONFLICT DO NOTHING;
+INSERT INTO staticord.member_emoji (guild, member, emoji)
+    SELECT 1, i, 'emoji' || i FROM generate_series(1, 10) AS i
+ON CONFLICT DO NOTHING;
+INSERT INTO staticord.message (id, guild, channel, user_id, content, datetime)
+    SELECT i, 1, i % 10, i % 100, repeat('message ', i % 20),
+           '2020-01-01'::timestamp + i * interval '1 minute'
+    FROM generate_series(1, 10000) AS i
+ON CONFLICT DO NOTHING;
+INSERT INTO staticord.nickname (guild, member, nickname, datetime)
+    SELECT 1, i % 100, 'nickname ' || i, '2020-01-01'::timestamp + i * interval '1 minute'
+    FROM generate_series(1, 1000) AS i;
+INSERT INTO staticord.activity (guild, member, status, type, name, start)
+    SELECT 1, i % 100, 'online', 'playing', 'game ' || i % 7,
+           '2020-01-01'::timestamp + i * interval '1 minute'
+    FROM generate_series(1, 1000) AS i;
+ANALYZE staticord.member, staticord.member_emoji, staticord.message, staticord.nickname,
+    staticord.activity;
+"""
+
+# Sample parameters of every statement of the db module
+STATEMENT_PARAMS = {
+    'MERGE_MESSAGE_STAGING_SQL': (),
+    'INSERT_MEMBER_SQL': (1, 1, 'name'),
+    'UPSERT_MEMBERS_SQL': (1, [1, 2], ['name 1', 'name 2']),
+    'INSERT_GUILD_SQL': (1, 'guild'),
+    'OPEN_ACTIVITIES_SQL': ([1], [1], ['online'], ['playing'], ['game'], [NOW], [None],
+                            [None], [None], [None], [None]),
+    'CLOSE_ACTIVITIES_SQL': ([1, 2], NOW, NOW),
+    'MEMBER_MESSAGE_STATS_SQL': (1, 1, NOW.date(), 5),
+    'GUILD_MESSAGE_STATS_SQL': (1, NOW.date(), 5),
+    'MEMBER_ACTIVITY_STATS_SQL': (1, 1, NOW, NOW, 5),
+    'GUILD_ACTIVITY_STATS_SQL': (1, NOW, NOW, 5),
+    'CREATE_MONTH_PARTITION_SQL': ('message', NOW.date()),
+    'INSERT_NICKNAME_SQL': (1, 1, 'nickname', NOW),
+    'GUILD_LAST_NICKNAMES_SQL': (1,),
+    'GUILD_LAST_ACTIVITIES_SQL': (1,),
+    'CHANNEL_CHECKPOINT_SQL': (1,),
+    'UPDATE_CHANNEL_CHECKPOINT_SQL': (1, 1, 1),
+    'SEARCH_MESSAGES_SQL': (1, 'message', 1, None, 0, 10000, 10),
+    'EXPORT_MESSAGES_SQL': (1, 0),
+    'EXPORT_ACTIVITIES_SQL': (1, 0),
+    'GUILD_MEMBER_EMOJIS': (1,),
+    'GUILD_MESSAGE_ID_RANGE_SQL': (1,),
+    'RANDOM_MESSAGES': (1, 50, [10, 5000]),
+}
+
+# Statements to run before planning a statement that depends on them
+STATEMENT_SETUP = {
+    'MERGE_MESSAGE_STAGING_SQL': db.CREATE_MESSAGE_STAGING_SQL,
+}
+
+QUERY_KEYWORDS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+logger = logging.getLogger(__name__)
+
+
+def db_statements():
+    """(name, sql) of every query of the db module"""
+
+    for name, value in sorted(vars(db).items()):
+        if name.isupper() and isinstance(value, str) and 'staticord.' in value \
+                and value.lstrip().upper().startswith(QUERY_KEYWORDS):
+            yield name, value
+
+
+def seq_scans(plan: dict):
+    """Tables of the staticord schema scanned sequentially in a plan"""
+
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Schema') == 'staticord':
+        yield plan['Relation Name']
+
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+async def check_plans(database: Db) -> list:
+    """Return the (statement, error) of every statement failing the check"""
+
+    failures = []
+
+    async with database.pool.acquire() as conn:
+        tr = conn.transaction()
+        await tr.start()
+
+        try:
+            await conn.execute(SEED_SQL)
+            # Sequential scans are still used when no index can answer the query
+            await conn.execute('SET LOCAL enable_seqscan = off')
+
+            for name, sql in db_statements():
+                if name not in STATEMENT_PARAMS:
+                    failures.append((name, 'no sample parameters'))
+                    continue
+
+                if name in STATEMENT_SETUP:
+                    await conn.execute(STATEMENT_SETUP[name])
+
+                explain = await conn.fetchval('EXPLAIN (VERBOSE, FORMAT JSON) ' + sql,
+                                              *STATEMENT_PARAMS[name])
+                plan = json.loads(explain)[0]['Plan']
+                tables = sorted(set(seq_scans(plan)))
+                if tables:
+                    failures.append((name, 'sequential scan on ' + ', '.join(tables)))
+                else:
+                    logger.info('%s: ok', name)
+
+        finally:
+            await tr.rollback()
+
+    return failures
+
+
+async def main() -> int:
+    """Connect to db and check every statement"""
+
+    with open('../config/config.yml', 'r') as config_file:
+        config = yaml.load(config_file, Loader=yaml.BaseLoader)
+
+    database = Db(config)
+    await database.connect_db()
+
+    try:
+        failures = await check_plans(database)
+    finally:
+        await database.close()
+
+    for name, error in failures:
+        logger.error('%s: %s', name, error)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    sys.exit(asyncio.get_event_loop().run_until_complete(main()))
@@ -4,27 +4,79 @@ Database interaction module
 import asyncio
 import datetime
 import logging
-from typing import Optional
+import os
+import random
+import re
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
 
 import asyncpg
 import discord
 
-INSERT_MESSAGE_SQL = """
-INSERT INTO staticord.message (id, guild, channel, user_id, content, datetime)
-    VALUES ($1, $2, $3, $4, $5, $6)
-ON CONFLICT (id) DO UPDATE
-    SET guild = message.guild,
-        channel = message.channel, 
-        user_id = message.user_id,
-        content = message.content,
-        datetime = message.datetime;
+from member_state import MemberSnapshot, MemberStateCache, activity_state
+from metrics import (DB_ERRORS, DB_POOL_ACQUIRE_SECONDS, DB_POOL_CONNECTIONS, DB_POOL_WAITING,
+                     DB_REPLICA_HEALTHY, DB_REPLICA_LAG_SECONDS, DB_STATEMENT_SECONDS,
+                     SPILL_REPLAYED_ROWS, SPILLED_ROWS, UPSERT_ROWS, timed)
+from schema import migrate
+from spill import SpillLog, decode_datetime, encode_datetime
+
+MESSAGE_COLUMNS = ('id', 'guild', 'channel', 'user_id', 'content', 'datetime')
+
+CREATE_MESSAGE_STAGING_SQL = """
+CREATE TEMPORARY TABLE IF NOT EXISTS message_staging
+    (LIKE staticord.message INCLUDING DEFAULTS)
+    ON COMMIT DELETE ROWS;
+"""
+
+# Saved messages are only rewritten when their content was edited, new messages are inserted
+# and counted in the daily rollup. The last staged row of a message wins, rows are staged in
+# the order they were queued so an edit comes after the message itself.
+MERGE_MESSAGE_STAGING_SQL = """
+WITH staged AS (
+    SELECT DISTINCT ON (id) id, guild, channel, user_id, content, datetime
+        FROM message_staging
+    ORDER BY id, ctid DESC
+), edited AS (
+    UPDATE staticord.message
+        SET content = staged.content
+        FROM staged
+        WHERE message.id = staged.id
+            AND message.content IS DISTINCT FROM staged.content
+    RETURNING message.id
+), inserted AS (
+    INSERT INTO staticord.message (id, guild, channel, user_id, content, datetime)
+        SELECT id, guild, channel, user_id, content, datetime
+        FROM staged
+    ON CONFLICT (id) DO NOTHING
+    RETURNING guild, channel, user_id, datetime
+), rollup AS (
+    INSERT INTO staticord.message_daily (guild, member, channel, day, messages)
+        SELECT guild, user_id, channel, datetime::date, count(*)
+        FROM inserted
+        GROUP BY guild, user_id, channel, datetime::date
+    ON CONFLICT (guild, member, channel, day) DO UPDATE
+        SET messages = message_daily.messages + excluded.messages
+)
+SELECT (SELECT count(*) FROM inserted) AS inserted,
+       (SELECT count(*) FROM edited) AS edited
 """
 
+# Upserts only rewrite rows whose values changed, unchanged rows are skipped
 INSERT_MEMBER_SQL = """
 INSERT INTO staticord.member (id, guild, name)
     VALUES ($1, $2, $3)
 ON CONFLICT (id, guild) DO UPDATE
-    SET name = member.name
+    SET name = excluded.name
+    WHERE member.name IS DISTINCT FROM excluded.name
+;
+"""
+
+UPSERT_MEMBERS_SQL = """
+INSERT INTO staticord.member (id, guild, name)
+    SELECT id, $1, name FROM unnest($2::bigint[], $3::text[]) AS m (id, name)
+ON CONFLICT (id, guild) DO UPDATE
+    SET name = excluded.name
+    WHERE member.name IS DISTINCT FROM excluded.name
 ;
 """
 
@@ -32,25 +84,114 @@ INSERT_GUILD_SQL = """
 INSERT INTO staticord.guild (id, name)
     VALUES ($1, $2)
 ON CONFLICT (id) DO UPDATE
-    SET name = guild.name;
+    SET name = excluded.name
+    WHERE guild.name IS DISTINCT FROM excluded.name;
 """
 
-INSERT_ACTIVITY_SQL = """
+OPEN_ACTIVITIES_SQL = """
 INSERT INTO staticord.activity (
-    guild, 
-    member, 
-    status, 
-    type, 
-    name, 
+    guild,
+    member,
+    status,
+    type,
+    name,
     start,
-    "end",
     listening_title,
     listening_artist,
     listening_album,
     listening_track_id,
     listening_party
-) 
-    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+)
+    SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::text[],
+                         $6::timestamp[], $7::text[], $8::text[], $9::text[], $10::text[],
+                         $11::text[])
+RETURNING guild, member, id, start
+"""
+
+# Closed intervals are split by day and added to the daily rollup. The earliest start of the
+# intervals limits the update to the partitions they can be in.
+CLOSE_ACTIVITIES_SQL = """
+WITH closed AS (
+    UPDATE staticord.activity
+        SET "end" = $2
+        WHERE id = ANY($1::bigint[])
+            AND start >= $3
+            AND "end" IS NULL
+    RETURNING guild, member, type, coalesce(listening_artist, name, '') AS name, start, "end"
+)
+INSERT INTO staticord.activity_daily (guild, member, type, name, day, seconds)
+    SELECT guild, member, type, name, day::date,
+           sum(extract(epoch FROM least("end", day + interval '1 day') - greatest(start, day)))
+    FROM closed,
+         generate_series(date_trunc('day', start), "end", interval '1 day') AS day
+    WHERE type IS NOT NULL
+    GROUP BY guild, member, type, name, day::date
+ON CONFLICT (guild, member, type, name, day) DO UPDATE
+    SET seconds = activity_daily.seconds + excluded.seconds;
+"""
+
+MEMBER_MESSAGE_STATS_SQL = """
+SELECT channel, sum(messages) AS messages
+    FROM staticord.message_daily
+    WHERE guild = $1
+        AND member = $2
+        AND day >= $3
+GROUP BY channel
+ORDER BY messages DESC
+LIMIT $4
+"""
+
+GUILD_MESSAGE_STATS_SQL = """
+SELECT member, sum(messages) AS messages
+    FROM staticord.message_daily
+    WHERE guild = $1
+        AND day >= $2
+GROUP BY member
+ORDER BY messages DESC
+LIMIT $3
+"""
+
+# Rolled up time, plus the time spent so far in open intervals
+MEMBER_ACTIVITY_STATS_SQL = """
+SELECT type, name, sum(seconds) AS seconds
+    FROM (
+        SELECT type, name, seconds
+            FROM staticord.activity_daily
+            WHERE guild = $1
+                AND member = $2
+                AND day >= $3::timestamp::date
+        UNION ALL
+        SELECT type, coalesce(listening_artist, name, ''),
+               extract(epoch FROM $4::timestamp - greatest(start, $3::timestamp))
+            FROM staticord.activity
+            WHERE guild = $1
+                AND member = $2
+                AND "end" IS NULL
+                AND type IS NOT NULL
+    ) activities
+GROUP BY type, name
+ORDER BY seconds DESC
+LIMIT $5
+"""
+
+GUILD_ACTIVITY_STATS_SQL = """
+SELECT type, name, sum(seconds) AS seconds
+    FROM (
+        SELECT type, name, seconds
+            FROM staticord.activity_daily
+            WHERE guild = $1
+                AND day >= $2::timestamp::date
+        UNION ALL
+        SELECT type, coalesce(listening_artist, name, ''),
+               extract(epoch FROM $3::timestamp - greatest(start, $2::timestamp))
+            FROM staticord.activity
+            WHERE guild = $1
+                AND "end" IS NULL
+                AND type IS NOT NULL
+    ) activities
+GROUP BY type, name
+ORDER BY seconds DESC
+LIMIT $4
 """
 
 INSERT_NICKNAME_SQL = """
@@ -58,23 +199,23 @@ INSERT INTO staticord.nickname (guild, member, nickname, datetime)
     VALUES ($1, $2, $3, $4)
 """
 
-MEMBER_LAST_NICKNAME_SQL = """
-SELECT nickname FROM staticord.nickname
+GUILD_LAST_NICKNAMES_SQL = """
+SELECT DISTINCT ON (member) member, nickname
+    FROM staticord.nickname
     WHERE guild = $1
-        AND member = $2
-ORDER BY datetime DESC
-LIMIT 1
+ORDER BY member, datetime DESC
 """
 
-MEMBER_LAST_ACTIVITY_SQL = """
-SELECT     
-    guild, 
-    member, 
-    status, 
-    type, 
-    name, 
+# Every member has one open interval, the latest one
+GUILD_LAST_ACTIVITIES_SQL = """
+SELECT DISTINCT ON (member)
+    id,
+    member,
     start,
     "end",
+    status,
+    type,
+    name,
     listening_title,
     listening_artist,
     listening_album,
@@ -82,46 +223,514 @@ SELECT
     listening_party
     FROM staticord.activity
     WHERE guild = $1
-        AND member = $2
-ORDER BY start DESC
-LIMIT 1
+        AND "end" IS NULL
+ORDER BY member, start DESC
 """
 
-CHANNEL_LAST_MESSAGE_DATE_SQL = """
-SELECT max(datetime) FROM staticord.message
+CHANNEL_CHECKPOINT_SQL = """
+SELECT last_message FROM staticord.channel_checkpoint
     WHERE channel = $1
 """
 
+UPDATE_CHANNEL_CHECKPOINT_SQL = """
+INSERT INTO staticord.channel_checkpoint (channel, guild, last_message)
+    VALUES ($1, $2, $3)
+ON CONFLICT (channel) DO UPDATE
+    SET last_message = excluded.last_message
+    WHERE channel_checkpoint.last_message < excluded.last_message;
+"""
+
+EXPORT_MESSAGES_SQL = """
+SELECT id, guild, channel, user_id, content, datetime
+    FROM staticord.message
+    WHERE guild = $1
+        AND id > $2
+ORDER BY id
+"""
+
+EXPORT_ACTIVITIES_SQL = """
+SELECT
+    id,
+    guild,
+    member,
+    status,
+    type,
+    name,
+    start,
+    "end",
+    listening_title,
+    listening_artist,
+    listening_album,
+    listening_track_id,
+    listening_party
+    FROM staticord.activity
+    WHERE guild = $1
+        AND id > $2
+ORDER BY id
+"""
+
+EXPORT_SQL = {
+    'message': EXPORT_MESSAGES_SQL,
+    'activity': EXPORT_ACTIVITIES_SQL,
+}
+
+# Filters are optional, results are paginated by id: the next page is before the last id
+SEARCH_MESSAGES_SQL = """
+SELECT id, channel, user_id, content, datetime
+    FROM staticord.message
+    WHERE guild = $1
+        AND search @@ websearch_to_tsquery('simple', $2)
+        AND ($3::bigint IS NULL OR user_id = $3)
+        AND ($4::bigint IS NULL OR channel = $4)
+        AND id > $5
+        AND id < $6
+ORDER BY id DESC
+LIMIT $7
+"""
+
+CREATE_MONTH_PARTITION_SQL = """
+SELECT staticord.create_month_partition($1, $2)
+"""
+
+# Monthly partitions of the partitioned tables, named after their month
+MONTH_PARTITIONS_SQL = """
+SELECT parent.relname AS parent, child.relname AS name,
+        pg_get_expr(child.relpartbound, child.oid) AS bound
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    JOIN pg_namespace ON pg_namespace.oid = parent.relnamespace
+    WHERE pg_namespace.nspname = 'staticord'
+        AND parent.relname = ANY($1::text[])
+"""
+
+LOCK_PARTITIONS_SQL = """
+SELECT pg_advisory_xact_lock($1)
+"""
+
+# Seconds the replica is behind the primary, 0 when it has replayed everything it received and
+# NULL when it is not streaming from the primary. The status is only visible with
+# pg_read_all_stats, other users only see that the WAL receiver is running.
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver
+                     WHERE coalesce(status, 'streaming') = 'streaming') THEN NULL
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())::float8
+END
+"""
+
 GUILD_MEMBER_EMOJIS = """
 SELECT member, emoji
 FROM staticord.member_emoji
 WHERE guild = $1;
 """
 
+GUILD_MESSAGE_ID_RANGE_SQL = """
+SELECT min(id), max(id) FROM staticord.message
+    WHERE guild = $1
+"""
+
+# Each probe id picks the first eligible message at or after it
 RANDOM_MESSAGES = """
-SELECT
+SELECT DISTINCT ON (msg.id)
+  msg.id AS message,
   msg.content,
   m.name,
   m.id,
   me.emoji
-FROM staticord.message msg
+FROM unnest($3::bigint[]) AS probe (id)
+CROSS JOIN LATERAL (
+    SELECT id, guild, user_id, content
+    FROM staticord.message
+    WHERE guild = $1
+       AND id >= probe.id
+       AND length(content) > $2
+       AND user_id IN (SELECT member FROM staticord.member_emoji)
+    ORDER BY id
+    LIMIT 1
+) msg
 JOIN staticord.member m on m.id = msg.user_id and m.guild = msg.guild
-JOIN staticord.member_emoji me on me.member = m.id
-WHERE m.guild = $1
-   AND length(msg.content) > $2
-ORDER BY random()
-LIMIT $3;
+JOIN staticord.member_emoji me on me.member = m.id;
 """
 
+RANDOM_MESSAGES_MIN_LENGTH = 50
+RANDOM_MESSAGES_ROUNDS = 3  # probe rounds before returning fewer messages than asked
+
+MESSAGE_BUFFER_BATCH_SIZE = 500
+MESSAGE_BUFFER_MAX_DELAY = 1  # in seconds
+MESSAGE_BUFFER_MAX_SIZE = 10000
+MEMBER_UPDATE_WINDOW = 5  # in seconds
+MEMBER_UPDATE_BATCH_SIZE = 1000
+SEARCH_PAGE_SIZE = 10
+SNOWFLAKE_MAX = 2 ** 63 - 1
+SPILL_DIRECTORY = '../spill'
+SPILL_FSYNC_INTERVAL = 1  # in seconds
+SPILL_MAX_SEGMENT_SIZE = 16 * 1024 * 1024  # in bytes
+SPILL_REPLAY_INTERVAL = 10  # in seconds
+PARTITIONED_TABLES = ('message', 'activity')
+PARTITION_NAME_PATTERN = re.compile(r'^(\w+)_(\d{4})_(\d{2})$')
+LEGACY_PARTITION_NAME_PATTERN = re.compile(r'^(\w+)_legacy$')
+PARTITION_UPPER_BOUND_PATTERN = re.compile(r"TO \('?([^')]+)'?\)")
+PARTITION_LOCK_KEY = 0x57A71C0E  # advisory lock held by the bot maintaining partitions
+PARTITION_MONTHS_AHEAD = 2
+PARTITION_MAINTENANCE_INTERVAL = 24 * 3600  # in seconds
+
+# Query roles, reads may be answered by a replica
+READ = 'read'
+WRITE = 'write'
+REPLICA_CHECK_INTERVAL = 5  # in seconds
+REPLICA_MAX_LAG = 10  # in seconds
+
+# Pool settings read from the db section of the config, the others keep the asyncpg defaults
+POOL_INT_OPTIONS = ('min_size', 'max_size', 'statement_cache_size')
+POOL_FLOAT_OPTIONS = ('command_timeout', 'max_inactive_connection_lifetime')
+CONNECT_TRIES = 5
+CONNECT_BACKOFF = 1  # in seconds, doubled after every failed try
+CONNECT_MAX_BACKOFF = 30  # in seconds
+
+# Statements of the message and member write paths, prepared once per primary connection
+HOT_STATEMENTS = (MERGE_MESSAGE_STAGING_SQL, UPSERT_MEMBERS_SQL, INSERT_MEMBER_SQL,
+                  INSERT_NICKNAME_SQL, CLOSE_ACTIVITIES_SQL, OPEN_ACTIVITIES_SQL)
+
+# Errors of queries, raised by the database, a lost connection or a pool acquire timeout.
+# Writes failing with them are spilled to disk, the transient ones may succeed later. A
+# connection terminated by the server while idle can fail its next query with an
+# InternalClientError.
+QUERY_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, asyncpg.InternalClientError,
+                OSError, asyncio.TimeoutError)
+TRANSIENT_ERRORS = (asyncpg.InterfaceError, asyncpg.InternalClientError,
+                    asyncpg.PostgresConnectionError, asyncpg.OperatorInterventionError,
+                    asyncpg.InsufficientResourcesError, asyncpg.ReadOnlySQLTransactionError,
+                    OSError, asyncio.TimeoutError)
+
 logger = logging.getLogger(__name__)
 
 
+def message_record(message: discord.Message) -> tuple:
+    """Row of staticord.message for a discord message"""
+    return (message.id, message.guild.id, message.channel.id, message.author.id,
+            message.content, message.created_at)
+
+
+def edited_message_record(payload: discord.RawMessageUpdateEvent) -> Optional[tuple]:
+    """
+    Row of staticord.message for an edited message, None if its content was not edited
+
+    Edits of messages that are not cached only carry the changed fields, the author comes
+    with the content of full edits.
+    """
+
+    data = payload.data
+    if 'content' not in data or 'guild_id' not in data:
+        return None
+
+    if 'author' in data:
+        author_id = int(data['author']['id'])
+    elif payload.cached_message is not None:
+        author_id = payload.cached_message.author.id
+    else:
+        return None
+
+    return (payload.message_id, int(data['guild_id']), payload.channel_id, author_id,
+            data['content'], discord.utils.snowflake_time(payload.message_id))
+
+
+def written_rows(status: Optional[str]) -> int:
+    """Rows written by a statement from its status, like INSERT 0 12"""
+    return int(status.split()[-1]) if status else 0
+
+
+def activity_record(member: discord.Member, start: datetime.datetime) -> tuple:
+    """Row of staticord.activity opening an interval for the current activity of a member"""
+    status, activity_type, name, *listening = activity_state(member)
+    return (member.guild.id, member.id, status, activity_type, name, start, *listening)
+
+
+def pool_options(config: dict) -> dict:
+    """Arguments of asyncpg.create_pool for the db section of the config, or its replica"""
+
+    options = {'host': config['host'], 'user': config['user'], 'password': config['password']}
+    if 'db' in config:
+        options['database'] = config['db']
+    for key in POOL_INT_OPTIONS:
+        if key in config:
+            options[key] = int(config[key])
+    for key in POOL_FLOAT_OPTIONS:
+        if key in config:
+            options[key] = float(config[key])
+    return options
+
+
+def pool_name(db: 'Db', pool: asyncpg.pool.Pool) -> str:
+    """Label of a pool in metrics"""
+    return 'replica' if pool is db.read_pool else 'primary'
+
+
+class StaticordConnection(asyncpg.Connection):
+    """
+    Primary connection whose statement cache holds the hot statements from the start
+
+    Statements of the cache are reused by every query of the connection with the same text,
+    across acquisitions, unlike the statements returned by `prepare`. The cache is filled
+    through the private `_get_statement`, the asyncpg versions it is known to work with are
+    pinned in requirements.txt.
+    """
+
+    __slots__ = ()
+
+    async def prepare_hot_statements(self) -> None:
+        """Prepare the hot statements into the statement cache"""
+
+        # The message merge reads the staging table, it lasts as long as the connection
+        await self.execute(CREATE_MESSAGE_STAGING_SQL)
+        for query in HOT_STATEMENTS:
+            await self._get_statement(query, None)
+
+
+async def prepare_statements(conn: StaticordConnection) -> None:
+    """Pool init hook, prepare the hot statements of a new connection"""
+
+    try:
+        await conn.prepare_hot_statements()
+    except (asyncpg.InvalidSchemaNameError, asyncpg.UndefinedTableError):
+        # Database not migrated yet, statements are prepared on first use
+        logger.debug('Schema not found, hot statements are prepared on first use')
+
+
+class PoolAcquire:
+    """
+    Async context manager acquiring a connection for a query role and timing the wait
+
+    Reads use the replica pool while it is healthy. A read that cannot get a replica
+    connection is retried on the primary, and the replica is marked unhealthy.
+    """
+
+    def __init__(self, db: 'Db', role: str):
+        self.db = db
+        self.role = role
+        self.pool = None
+        self.conn = None
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        start = time.perf_counter()
+        self.pool = self.db.pool_for(self.role)
+
+        try:
+            self.conn = await self._acquire()
+        except TRANSIENT_ERRORS as err:
+            if self.pool is self.db.pool:
+                raise
+            self.db.replica_failed(err)
+            self.pool = self.db.pool
+            self.conn = await self._acquire()
+
+        DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - start,
+                                        pool_name(self.db, self.pool))
+        self.db.update_pool_metrics(self.pool)
+        return self.conn
+
+    async def _acquire(self) -> asyncpg.Connection:
+        """Acquire a connection of the pool within the acquire timeout, counting the waiters"""
+
+        name = pool_name(self.db, self.pool)
+        self.db.pool_waiting[name] += 1
+        DB_POOL_WAITING.set(self.db.pool_waiting[name], name)
+
+        try:
+            return await self.pool.acquire(timeout=self.db.acquire_timeout)
+        except asyncio.TimeoutError:
+            DB_ERRORS.inc('pool_acquire')
+            logger.error('No connection of the %s pool free after %s seconds', name,
+                         self.db.acquire_timeout)
+            raise
+        finally:
+            self.db.pool_waiting[name] -= 1
+            DB_POOL_WAITING.set(self.db.pool_waiting[name], name)
+
+    async def __aexit__(self, exc_type, exc, _) -> None:
+        await self.pool.release(self.conn)
+        self.db.update_pool_metrics(self.pool)
+        if exc_type and issubclass(exc_type, TRANSIENT_ERRORS) and self.pool is self.db.read_pool:
+            self.db.replica_failed(exc)
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for live messages
+
+    Messages are queued as rows and flushed in bulk once `batch_size` rows are waiting or
+    `max_delay` seconds after the first row of a batch. The queue is bounded: when it is full,
+    `put` waits for the writer to catch up.
+    """
+
+    def __init__(self, db: 'Db', batch_size: int, max_delay: float, max_size: int):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the flushing task"""
+        self.task = asyncio.ensure_future(self._run())
+
+    async def put(self, message: discord.Message) -> None:
+        """Queue a message, waiting if the buffer is full"""
+        await self.queue.put(message_record(message))
+
+    async def put_record(self, record: tuple) -> None:
+        """Queue a message row, waiting if the buffer is full"""
+        await self.queue.put(record)
+
+    async def close(self) -> None:
+        """Flush every queued message and stop the flushing task"""
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        closing = False
+
+        while not closing:
+            record = await self.queue.get()
+            if record is None:
+                break
+
+            batch = [record]
+            deadline = loop.time() + self.max_delay
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    record = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if record is None:
+                    closing = True
+                    break
+                batch.append(record)
+
+            await self.db.merge_message_records(batch)
+
+
+class MemberUpdateCoalescer:
+    """
+    Coalesce member updates before saving them
+
+    Only the latest state of each member is kept. Pending members are saved in one batch
+    `window` seconds after the first update, or as soon as `batch_size` members are pending.
+    Batches may be flushed while a previous one is being saved, Db saves them in order.
+    """
+
+    def __init__(self, db: 'Db', window: float, batch_size: int):
+        self.db = db
+        self.window = window
+        self.batch_size = batch_size
+        self.pending: Dict[Tuple[int, int], discord.Member] = {}
+        self.timer: Optional[asyncio.Task] = None
+
+    def add(self, member: discord.Member) -> None:
+        """Schedule the save of a member, replacing its pending state if any"""
+
+        self.pending[(member.guild.id, member.id)] = member
+
+        if len(self.pending) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif not self.timer:
+            self.timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Save every pending member"""
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        members = list(self.pending.values())
+        self.pending.clear()
+        if members:
+            await self.db.save_member_updates(members)
+
+
 class Db:
-    """Database interacetion class"""
+    """
+    Database interacetion class
 
-    def __init__(self, config):
+    With a `worker` number, failed writes of messages and members are kept in a spill log of
+    the worker and replayed once the database is back.
+    """
+
+    def __init__(self, config, worker: Optional[int] = None):
         self.pool: asyncpg.pool.Pool = None
         self.config = config
+        self.member_states = MemberStateCache()
+
+        # Optional hot standby answering the read queries, with the credentials of the primary
+        # unless it has its own
+        self.replica_config = None
+        if 'replica' in config['db']:
+            self.replica_config = {key: config['db'][key] for key in ('user', 'password', 'db')
+                                   if key in config['db']}
+            self.replica_config.update(config['db']['replica'])
+        self.read_pool: Optional[asyncpg.pool.Pool] = None
+        self.replica_healthy = False
+        self.replica_task: Optional[asyncio.Task] = None
+
+        # Without an acquire timeout, queries wait for a free connection as long as it takes
+        self.acquire_timeout = float(config['db']['acquire_timeout']) \
+            if 'acquire_timeout' in config['db'] else None
+        self.pool_waiting = {'primary': 0, 'replica': 0}
+
+        # Retention of 0 months keeps every partition
+        partition_config = config['db'].get('partitions', {})
+        self.partition_months_ahead = int(partition_config.get('months_ahead',
+                                                               PARTITION_MONTHS_AHEAD))
+        self.partition_retention = int(partition_config.get('retention_months', 0))
+        self.partition_drop = partition_config.get('retention_action', 'detach') == 'drop'
+        self.partition_task: Optional[asyncio.Task] = None
+
+        # Member writes and spill replays compare members to the cached states and update
+        # them, they run one at a time so that an interval is never closed or opened twice.
+        # Backfill merges wait for the replay under it too.
+        self.member_lock = asyncio.Lock()
+
+        self.spill: Optional[SpillLog] = None
+        self.spill_task: Optional[asyncio.Task] = None
+        spill_config = config['db'].get('spill', {})
+        self.spill_replay_interval = float(spill_config.get('replay_interval',
+                                                            SPILL_REPLAY_INTERVAL))
+        if worker is not None:
+            self.spill = SpillLog(
+                os.path.join(spill_config.get('directory', SPILL_DIRECTORY), str(worker)),
+                fsync_interval=float(spill_config.get('fsync_interval', SPILL_FSYNC_INTERVAL)),
+                max_segment_size=int(spill_config.get('max_segment_size',
+                                                      SPILL_MAX_SEGMENT_SIZE)))
+
+        buffer_config = config['db'].get('message_buffer', {})
+        self.message_buffer = MessageBuffer(
+            self,
+            batch_size=int(buffer_config.get('batch_size', MESSAGE_BUFFER_BATCH_SIZE)),
+            max_delay=float(buffer_config.get('max_delay', MESSAGE_BUFFER_MAX_DELAY)),
+            max_size=int(buffer_config.get('max_size', MESSAGE_BUFFER_MAX_SIZE)))
+
+        update_config = config['db'].get('member_updates', {})
+        self.member_updates = MemberUpdateCoalescer(
+            self,
+            window=float(update_config.get('window', MEMBER_UPDATE_WINDOW)),
+            batch_size=int(update_config.get('batch_size', MEMBER_UPDATE_BATCH_SIZE)))
 
     async def connect_db(self) -> None:
         """Connect to db"""
@@ -129,189 +738,755 @@ class Db:
         logger.info('Connecting to postgres host: %s, user: %s',
                     self.config['db']['host'],
                     self.config['db']['user'])
-        n_try = 0
-        n_max_try = 3
-        wait_time = 1  # in seconds
-
-        while not self.pool and n_try < n_max_try:
-            n_try += 1
+        n_max_try = int(self.config['db'].get('connect_tries', CONNECT_TRIES))
 
+        for n_try in range(1, n_max_try + 1):
             try:
-                self.pool = await asyncpg.create_pool(host=self.config['db']['host'],
-                                                      user=self.config['db']['user'],
-                                                      password=self.config['db']['password'])
-            except asyncpg.PostgresError as err:
-                logger.error('Cannot connect to database, retry in %d seconds', wait_time)
-                await asyncio.sleep(wait_time)
-
-                if n_try < n_max_try:
-                    break
-                else:
+                self.pool = await asyncpg.create_pool(**pool_options(self.config['db']),
+                                                      connection_class=StaticordConnection,
+                                                      init=prepare_statements)
+                break
+            except QUERY_ERRORS as err:
+                if n_try == n_max_try:
                     logger.error('Max number of connection tries attempted, exiting')
-                    raise err
+                    raise
+
+                # Exponential backoff with jitter, so that restarted workers do not retry
+                # all at once
+                backoff = min(CONNECT_MAX_BACKOFF, CONNECT_BACKOFF * 2 ** (n_try - 1))
+                wait_time = backoff / 2 + random.uniform(0, backoff / 2)
+                logger.error('%s %s, cannot connect to database, retry in %.1f seconds',
+                             type(err).__name__, err, wait_time)
+                await asyncio.sleep(wait_time)
 
         logger.debug('Connected to database')
+        if await migrate(self.pool):
+            # Statements were prepared against the previous schema
+            await self.pool.expire_connections()
+        self.update_pool_metrics(self.pool)
+        self.message_buffer.start()
+        if self.spill:
+            self.spill_task = asyncio.ensure_future(self._replay_spill_periodically())
+        if self.replica_config:
+            self.replica_task = asyncio.ensure_future(self._monitor_replica())
+        self.partition_task = asyncio.ensure_future(self._maintain_partitions_periodically())
 
-    async def save_mesage(self, message: discord.Message) -> None:
-        """Save message to db"""
+    def acquire(self, role: str) -> PoolAcquire:
+        """Acquire a pool connection for a READ or WRITE query, recording the time waited"""
 
-        logger.debug('Save message %s', message)
+        return PoolAcquire(self, role)
 
-        try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(INSERT_MESSAGE_SQL, message.id, message.guild.id,
-                                   message.channel.id, message.author.id,
-                                   message.content, message.created_at)
+    def update_pool_metrics(self, pool: asyncpg.pool.Pool) -> None:
+        """Report the open, idle and maximum connections of a pool"""
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, message that created exception %s', err, message)
-
-    async def save_member_activity(self, member: discord.Member) -> None:
-        """Save member activity to db"""
-
-        logger.debug('Saving activity %s for member %s', member.activity, member.name)
-
-        activity_type = member.activity.type.name if member.activity else None
-        activity_name = member.activity.name if member.activity else None
-        start = member.activity.start if member.activity else datetime.datetime.now()
-        end = member.activity.end if member.activity else None
-
-        listening_title = member.activity.title if isinstance(member.activity, discord.Spotify) \
-            else None
-        listening_artist = member.activity.artist if isinstance(member.activity, discord.Spotify) \
-            else None
-        listening_album = member.activity.album if isinstance(member.activity, discord.Spotify) \
-            else None
-        listening_track_id = member.activity.track_id if isinstance(member.activity,
-                                                                    discord.Spotify) \
-            else None
-        listening_party = member.activity.party_id if isinstance(member.activity, discord.Spotify) \
-            else None
+        name = pool_name(self, pool)
+        DB_POOL_CONNECTIONS.set(pool.get_size(), name, 'open')
+        DB_POOL_CONNECTIONS.set(pool.get_idle_size(), name, 'idle')
+        DB_POOL_CONNECTIONS.set(pool.get_max_size(), name, 'max')
 
-        try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(INSERT_ACTIVITY_SQL, member.guild.id, member.id,
-                                   member.status.value, activity_type, activity_name, start,
-                                   end, listening_title, listening_artist, listening_album,
-                                   listening_track_id, listening_party)
+    def pool_for(self, role: str) -> asyncpg.pool.Pool:
+        """Pool answering the queries of a role"""
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, activity provocing %s, from '
-                         'member: %s', err, member.activity, member)
+        if role == READ and self.replica_healthy:
+            return self.read_pool
+        return self.pool
+
+    def replica_failed(self, err: Exception) -> None:
+        """Send reads to the primary until the replica passes a check again"""
+
+        if self.replica_healthy:
+            logger.warning('%s %s, reading from the primary', type(err).__name__, err)
+            self.replica_healthy = False
+            DB_REPLICA_HEALTHY.set(0)
+
+    async def _monitor_replica(self) -> None:
+        max_lag = float(self.replica_config.get('max_lag', REPLICA_MAX_LAG))
+
+        while True:
+            await self.check_replica(max_lag)
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
 
-    async def get_member_last_nickname(self, member: discord.Member) -> Optional[str]:
-        """Get the last nickname of a member"""
+    async def check_replica(self, max_lag: float) -> None:
+        """
+        Connect to the replica if needed, and use it for reads while it is less than
+        `max_lag` seconds behind the primary
+        """
 
-        logger.debug('Get member last nickname %s', member)
+        lag = None
 
         try:
-            async with self.pool.acquire() as conn:
-                return await conn.fetchval(MEMBER_LAST_NICKNAME_SQL, member.guild.id, member.id) \
-                       or None
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, while fetching nickname of '
-                         'member: %s', err, member)
+            if self.read_pool is None:
+                self.read_pool = await asyncpg.create_pool(**pool_options(self.replica_config))
+
+            async with self.read_pool.acquire() as conn:
+                lag = await conn.fetchval(REPLICA_LAG_SQL)
+
+        except QUERY_ERRORS as err:
+            logger.debug('%s %s, while checking the replica', type(err).__name__, err)
+
+        if lag is not None:
+            DB_REPLICA_LAG_SECONDS.set(lag)
 
-    async def get_member_last_activity(self, member: discord.Member) -> Optional:
-        """Get the last nickname of a member"""
+        healthy = lag is not None and lag <= max_lag
+        if healthy != self.replica_healthy:
+            logger.warning('Replica %s, lag: %s seconds',
+                           'healthy, reading from it' if healthy else 'unavailable or lagging',
+                           lag)
+        self.replica_healthy = healthy
+        DB_REPLICA_HEALTHY.set(int(healthy))
 
-        logger.debug('Get member last activity %s', member)
+    async def close(self) -> None:
+        """Flush pending writes and close the pool"""
+
+        logger.info('Flushing pending writes and closing database pool')
+        if self.spill_task:
+            self.spill_task.cancel()
+            self.spill_task = None
+        if self.replica_task:
+            self.replica_task.cancel()
+            self.replica_task = None
+        if self.partition_task:
+            self.partition_task.cancel()
+            self.partition_task = None
+
+        await self.message_buffer.close()
+        await self.member_updates.flush()
+        if self.spill:
+            self.spill.close()
+
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+        if self.read_pool:
+            self.replica_healthy = False
+            await self.read_pool.close()
+            self.read_pool = None
+
+    @timed(DB_STATEMENT_SECONDS, 'queue_message')
+    async def queue_message(self, message: discord.Message) -> None:
+        """Queue message to be saved by the write-behind buffer"""
+
+        await self.message_buffer.put(message)
+
+    @timed(DB_STATEMENT_SECONDS, 'queue_message_edit')
+    async def queue_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        """
+        Queue the new content of an edited message, it goes through the write-behind buffer
+        so that it is saved after the message itself
+        """
+
+        record = edited_message_record(payload)
+        if record:
+            await self.message_buffer.put_record(record)
+
+    def queue_member_update(self, member: discord.Member) -> None:
+        """Queue member to be saved by the member update coalescer"""
+
+        self.member_updates.add(member)
+
+    async def _maintain_partitions_periodically(self) -> None:
+        while True:
+            await self.maintain_partitions()
+            await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+    @timed(DB_STATEMENT_SECONDS, 'maintain_partitions')
+    async def maintain_partitions(self) -> None:
+        """
+        Create the monthly partitions of the current and next months, and detach or drop the
+        partitions older than the retention period
+        """
+
+        today = datetime.datetime.utcnow().date()
+        month = today.year * 12 + today.month - 1  # months since year 0
+
+        def month_date(months: int) -> datetime.date:
+            return datetime.date(months // 12, months % 12 + 1, 1)
 
         try:
-            async with self.pool.acquire() as conn:
-                activity_row = await conn.fetchrow(MEMBER_LAST_ACTIVITY_SQL, member.guild.id,
-                                                   member.id)
-            return {
-                'guild': activity_row['guild'],
-                'member': activity_row['member'],
-                'status': activity_row['status'],
-                'type': activity_row['type'],
-                'name': activity_row['name'],
-                'start': activity_row['start'],
-                'end': activity_row['end'],
-                'listening_title': activity_row['listening_title'],
-                'listening_artist': activity_row['listening_artist'],
-                'listening_album': activity_row['listening_album'],
-                'listening_track_id': activity_row['listening_track_id'],
-                'listening_party': activity_row['listening_party']
-            } if activity_row else None
+            async with self.acquire(WRITE) as conn:
+                async with conn.transaction():
+                    await conn.fetchval(LOCK_PARTITIONS_SQL, PARTITION_LOCK_KEY)
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, while fetching activity of member: %s', err, member)
+                    for table in PARTITIONED_TABLES:
+                        for ahead in range(self.partition_months_ahead + 1):
+                            if await conn.fetchval(CREATE_MONTH_PARTITION_SQL, table,
+                                                   month_date(month + ahead)):
+                                logger.info('Created partition of %s for %s', table,
+                                            month_date(month + ahead))
 
-    async def save_member_nickname(self, member: discord.Member) -> None:
-        """Save member nickname to db if it has changed"""
+                    if not self.partition_retention:
+                        return
+
+                    for row in await conn.fetch(MONTH_PARTITIONS_SQL, PARTITIONED_TABLES):
+                        end_month = self.partition_end_month(row)
+                        if end_month is None or end_month > month - self.partition_retention:
+                            continue
+
+                        # Names come from the catalog and match a partition name pattern
+                        if self.partition_drop:
+                            await conn.execute(f'DROP TABLE staticord.{row["name"]}')
+                        else:
+                            await conn.execute(f'ALTER TABLE staticord.{row["parent"]} '
+                                               f'DETACH PARTITION staticord.{row["name"]}')
+                        logger.warning('%s partition %s past the retention period',
+                                       'Dropped' if self.partition_drop else 'Detached',
+                                       row['name'])
+
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('maintain_partitions')
+            logger.error('%s %s, while maintaining partitions', type(err).__name__, err)
 
-        logger.debug('Saving nickname %s', member.nick)
+    @staticmethod
+    def partition_end_month(row: asyncpg.Record) -> Optional[int]:
+        """
+        First month after the rows of a monthly or legacy partition, in months since year 0
+
+        The legacy partitions start from the first row and end at the month the partitioning
+        migration ran. Other partitions, like the default ones, have no end month.
+        """
+
+        match = PARTITION_NAME_PATTERN.match(row['name'])
+        if match and match.group(1) == row['parent']:
+            return int(match.group(2)) * 12 + int(match.group(3))
+
+        match = LEGACY_PARTITION_NAME_PATTERN.match(row['name'])
+        bound = PARTITION_UPPER_BOUND_PATTERN.search(row['bound'] or '')
+        if not match or match.group(1) != row['parent'] or not bound:
+            return None
+
+        if row['parent'] == 'message':
+            end = discord.utils.snowflake_time(int(bound.group(1)))
+        else:
+            end = datetime.datetime.strptime(bound.group(1)[:10], '%Y-%m-%d')
+        return end.year * 12 + end.month - 1
+
+    @timed(DB_STATEMENT_SECONDS, 'merge_message_records')
+    async def merge_message_records(self, records: List[tuple], checkpoint: bool = False) -> bool:
+        """
+        Save a large batch of message rows to db, return whether it was merged
+
+        Rows are loaded with COPY into a per-connection staging table, then merged into
+        staticord.message with a single statement. With `checkpoint`, the rows must belong to
+        one channel and its backfill checkpoint is moved to the last row in the same
+        transaction.
+
+        Failed batches are spilled, except backfill batches that are fetched again from the
+        checkpoint. While the spill log has records to replay, live batches are spilled behind
+        them and backfill batches wait for the replay, so that an older edit is never merged
+        over a newer one.
+        """
+
+        logger.debug('Merge %d messages', len(records))
+
+        if self.spill and self.spill.pending:
+            if not checkpoint:
+                self._spill_messages(records)
+                return False
+            if not await self.replay_spill():
+                return False
 
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(INSERT_NICKNAME_SQL, member.guild.id, member.id, member.nick,
-                                   datetime.datetime.now())
+            inserted, edited = await self._merge_message_records(records, checkpoint)
+            logger.debug('Merged %d messages: %d inserted, %d edited, %d unchanged',
+                         len(records), inserted, edited, len(records) - inserted - edited)
+            return True
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, activity provocing %s, from member: %s', err,
-                         member.activity, member)
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('merge_message_records')
+            logger.error('%s %s, while merging a batch of %d messages', type(err).__name__, err,
+                         len(records))
+            if not checkpoint:
+                self._spill_messages(records)
+            return False
+
+    async def _merge_message_records(self, records: List[tuple],
+                                     checkpoint: bool = False) -> Tuple[int, int]:
+        """Merge message rows, return the number of rows inserted and edited"""
+
+        async with self.acquire(WRITE) as conn:
+            async with conn.transaction():
+                await conn.execute(CREATE_MESSAGE_STAGING_SQL)
+                await conn.copy_records_to_table('message_staging', records=records,
+                                                 columns=MESSAGE_COLUMNS)
+                inserted, edited = await conn.fetchrow(MERGE_MESSAGE_STAGING_SQL)
+
+                if checkpoint:
+                    last = max(records)
+                    await conn.execute(UPDATE_CHANNEL_CHECKPOINT_SQL, last[2], last[1], last[0])
+
+        # Rows repeated in the batch are merged once and counted as unchanged
+        UPSERT_ROWS.inc('message', 'written', amount=inserted + edited)
+        UPSERT_ROWS.inc('message', 'skipped', amount=len(records) - inserted - edited)
+        return inserted, edited
 
-    async def get_channel_last_saved_message_date(self, channel: discord.TextChannel) -> Optional[
-            datetime.datetime]:
-        """Get the timestamp of the last message of a channel"""
+    @timed(DB_STATEMENT_SECONDS, 'get_channel_checkpoint')
+    async def get_channel_checkpoint(self, channel: discord.TextChannel) -> Optional[int]:
+        """
+        Get the id of the last message saved by the backfill of a channel, 0 if the channel
+        was never backfilled and None if the checkpoint could not be read
+        """
 
-        logger.debug('Get channel last message %s', channel)
+        logger.debug('Get channel checkpoint %s', channel)
 
         try:
-            async with self.pool.acquire() as conn:
-                return await conn.fetchval(CHANNEL_LAST_MESSAGE_DATE_SQL, channel.id) or None
+            async with self.acquire(WRITE) as conn:
+                return await conn.fetchval(CHANNEL_CHECKPOINT_SQL, channel.id) or 0
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, get last from channel %s', err, channel.id)
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('get_channel_checkpoint')
+            logger.error('%s %s, get last from channel %s', type(err).__name__, err,
+                         channel.id)
 
-    async def save_member(self, member: discord.Member):
-        """Save member nickname to db if it has changed"""
+    @timed(DB_STATEMENT_SECONDS, 'sync_guild_members')
+    async def sync_guild_members(self, guild: discord.Guild, members: List[discord.Member],
+                                 load_states: bool = True, activities: bool = True,
+                                 close_absent: bool = False) -> None:
+        """
+        Save members of a guild with their nickname and activity if they have changed
+
+        Members are upserted in one statement, then compared to the latest nickname and
+        activity rows of the guild loaded in bulk, and only changed rows are inserted.
+
+        A guild can be synced in several calls: the saved states are loaded by the first one
+        only, with `load_states`. Members fetched from the API have no presence, they are
+        synced without `activities`. With `close_absent`, `members` holds every member with a
+        presence and the open activity intervals of the other members of the guild, left or
+        offline, are closed.
+        """
+
+        logger.debug('Sync %d members of guild %s', len(members), guild.name)
+
+        async with self.member_lock:
+            # Spilled states are older than the synced ones
+            if self.spill and self.spill.pending:
+                await self.spill.replay(self._replay_record)
+
+            try:
+                async with self.acquire(WRITE) as conn:
+                    if load_states:
+                        self.member_states.load(
+                            guild.id, await conn.fetch(GUILD_LAST_NICKNAMES_SQL, guild.id),
+                            await conn.fetch(GUILD_LAST_ACTIVITIES_SQL, guild.id))
+
+                    utcnow = datetime.datetime.utcnow()
+                    async with conn.transaction():
+                        written = written_rows(await conn.execute(
+                            UPSERT_MEMBERS_SQL, guild.id, [m.id for m in members],
+                            [m.name for m in members]))
+                        changes = await self._insert_member_changes(conn, members,
+                                                                    datetime.datetime.now(),
+                                                                    utcnow, activities)
+                        closed = []
+                        if close_absent:
+                            absent = (set(self.member_states.open_activities(guild.id))
+                                      - {m.id for m in members})
+                            closed = await self._close_member_activities(conn, guild.id,
+                                                                         absent, utcnow)
+
+                self._set_member_states(members, *changes)
+                for member_id in closed:
+                    self.member_states.close_activity(guild.id, member_id)
+
+                UPSERT_ROWS.inc('member', 'written', amount=written)
+                UPSERT_ROWS.inc('member', 'skipped', amount=len(members) - written)
+                logger.info('Synced %d members of guild %s: %d written, %d unchanged, %d new '
+                            'nicknames, %d new activities, %d closed', len(members), guild.name,
+                            written, len(members) - written, len(changes[0]), len(changes[1]),
+                            len(closed))
+
+            except QUERY_ERRORS as err:
+                DB_ERRORS.inc('sync_guild_members')
+                logger.error('%s %s, while syncing members of guild %s', type(err).__name__, err,
+                             guild)
+                # Members without presence are fetched again by the next sync
+                if activities:
+                    self._spill_members(members)
+
+    @timed(DB_STATEMENT_SECONDS, 'close_member_activities')
+    async def close_member_activities(self, guild: discord.Guild,
+                                      member_ids: Optional[List[int]] = None) -> None:
+        """
+        Close the open activity intervals of members that left a guild, or of every member of
+        the guild without `member_ids`
+
+        Spilled states are replayed first so that they do not open the intervals again. If
+        the close fails, the next sync of the guild closes the intervals of absent members.
+        """
+
+        logger.debug('Close activities of %s members of guild %s',
+                     len(member_ids) if member_ids is not None else 'all', guild.id)
+
+        async with self.member_lock:
+            if self.spill and self.spill.pending:
+                await self.spill.replay(self._replay_record)
+
+            try:
+                async with self.acquire(WRITE) as conn:
+                    await self._load_member_states(conn, {guild.id})
+                    if member_ids is None:
+                        member_ids = list(self.member_states.open_activities(guild.id))
+                    async with conn.transaction():
+                        closed = await self._close_member_activities(
+                            conn, guild.id, member_ids, datetime.datetime.utcnow())
+
+                for member_id in closed:
+                    self.member_states.close_activity(guild.id, member_id)
+
+            except QUERY_ERRORS as err:
+                DB_ERRORS.inc('close_member_activities')
+                logger.error('%s %s, while closing activities of guild %s', type(err).__name__,
+                             err, guild)
+
+    @timed(DB_STATEMENT_SECONDS, 'save_member_updates')
+    async def save_member_updates(self, members: List[discord.Member]) -> None:
+        """
+        Save members of any guild, writing only the rows that changed since the last save
+
+        While the spill log has records to replay, members are spilled behind them so that
+        their states are saved in order.
+        """
 
-        logger.debug('Saving member %s', member.name)
+        logger.debug('Save %d updated members', len(members))
+
+        async with self.member_lock:
+            if self.spill and self.spill.pending:
+                self._spill_members(members)
+                return
+
+            try:
+                await self._save_member_updates(members, datetime.datetime.now(),
+                                                datetime.datetime.utcnow())
+
+            except QUERY_ERRORS as err:
+                DB_ERRORS.inc('save_member_updates')
+                logger.error('%s %s, while saving %d updated members', type(err).__name__, err,
+                             len(members))
+                self._spill_members(members)
+
+    async def _save_member_updates(self, members: List[discord.Member], now: datetime.datetime,
+                                   utcnow: datetime.datetime) -> None:
+        async with self.acquire(WRITE) as conn:
+            # Compare to the saved states, the guild may not be synced yet after a restart
+            await self._load_member_states(conn, {m.guild.id for m in members})
+            changed_names = [m for m in members if self.member_states.name_changed(m)]
+
+            async with conn.transaction():
+                if changed_names:
+                    await conn.executemany(INSERT_MEMBER_SQL,
+                                           [(m.id, m.guild.id, m.name) for m in changed_names])
+                changes = await self._insert_member_changes(conn, members, now, utcnow)
+
+        self._set_member_states(changed_names, *changes)
+
+    async def _load_member_states(self, conn: asyncpg.Connection, guild_ids: Set[int]) -> None:
+        """Load the saved states of the guilds that are not in the state cache yet"""
+
+        for guild_id in guild_ids - self.member_states.guilds:
+            self.member_states.load(guild_id, await conn.fetch(GUILD_LAST_NICKNAMES_SQL, guild_id),
+                                    await conn.fetch(GUILD_LAST_ACTIVITIES_SQL, guild_id))
+
+    async def _insert_member_changes(self, conn: asyncpg.Connection,
+                                     members: List[discord.Member], now: datetime.datetime,
+                                     utcnow: datetime.datetime,
+                                     activities: bool = True) -> Tuple[List, List]:
+        """
+        Insert the nickname of members that changed since the last save, close the activity
+        interval of members whose activity changed and open a new one
+
+        Nicknames are dated `now`. Intervals follow each other: the previous one ends when the
+        next one starts, at `utcnow` since the times of activities are UTC like the
+        timestamps of discord.
+
+        Activities are left as they are without `activities`. Return the members with a new
+        nickname and the (member, (id, start)) of the intervals opened.
+        """
+
+        changed_nicknames = [m for m in members if self.member_states.nickname_changed(m)]
+        changed_activities = [m for m in members
+                              if activities and self.member_states.activity_changed(m)]
+
+        if changed_nicknames:
+            await conn.executemany(INSERT_NICKNAME_SQL,
+                                   [(m.guild.id, m.id, m.nick, now) for m in changed_nicknames])
+
+        opened = {}
+        if changed_activities:
+            intervals = [self.member_states.open_activity(m) for m in changed_activities]
+            intervals = [interval for interval in intervals if interval]
+            await conn.execute(CLOSE_ACTIVITIES_SQL, [i for i, _ in intervals], utcnow,
+                               min((start for _, start in intervals), default=utcnow))
+
+            columns = list(zip(*(activity_record(m, utcnow) for m in changed_activities)))
+            rows = await conn.fetch(OPEN_ACTIVITIES_SQL, *columns)
+            opened = {(row['guild'], row['member']): (row['id'], row['start']) for row in rows}
+
+        return changed_nicknames, [(m, opened[(m.guild.id, m.id)]) for m in changed_activities]
+
+    async def _close_member_activities(self, conn: asyncpg.Connection, guild_id: int,
+                                       member_ids: Iterable[int],
+                                       utcnow: datetime.datetime) -> List[int]:
+        """Close the open activity intervals of members of a guild, return the members closed"""
+
+        open_activities = self.member_states.open_activities(guild_id)
+        closed = [member_id for member_id in member_ids if member_id in open_activities]
+        if closed:
+            intervals = [open_activities[member_id] for member_id in closed]
+            await conn.execute(CLOSE_ACTIVITIES_SQL, [i for i, _ in intervals], utcnow,
+                               min(start for _, start in intervals))
+        return closed
+
+    def _set_member_states(self, names: List[discord.Member], nicknames: List[discord.Member],
+                           activities: List[Tuple[discord.Member, tuple]]) -> None:
+        """Record saved member rows, nicknames and opened activities in the state cache"""
+
+        for member in names:
+            self.member_states.set_name(member)
+        for member in nicknames:
+            self.member_states.set_nickname(member)
+        for member, interval in activities:
+            self.member_states.set_activity(member, interval)
+
+    def _spill_messages(self, records: List[tuple]) -> None:
+        """Append message rows to the spill log"""
+
+        if self.spill:
+            self.spill.append({'kind': 'messages',
+                               'rows': [[*r[:5], encode_datetime(r[5])] for r in records]})
+            SPILLED_ROWS.inc('messages', amount=len(records))
+
+    def _spill_members(self, members: List[discord.Member]) -> None:
+        """Append the current state of members to the spill log"""
+
+        if self.spill:
+            self.spill.append({'kind': 'members',
+                               'now': encode_datetime(datetime.datetime.now()),
+                               'utcnow': encode_datetime(datetime.datetime.utcnow()),
+                               'members': [MemberSnapshot.from_member(m).to_list()
+                                           for m in members]})
+            SPILLED_ROWS.inc('members', amount=len(members))
+
+    async def _replay_spill_periodically(self) -> None:
+        while True:
+            if self.spill.pending:
+                await self.replay_spill()
+            await asyncio.sleep(self.spill_replay_interval)
+
+    async def replay_spill(self) -> bool:
+        """Replay the spill log, return whether every record was saved"""
+
+        async with self.member_lock:
+            return await self.spill.replay(self._replay_record)
+
+    async def _replay_record(self, record: dict) -> bool:
+        """
+        Save a spilled record through the idempotent message merge or the diff based member
+        path. Return False if it failed because the database is still unavailable.
+
+        A record failing otherwise is replayed again row by row, and only the rows that still
+        fail are dropped.
+        """
+
+        kind = record['kind']
+        if kind == 'messages':
+            rows = [(*r[:5], decode_datetime(r[5])) for r in record['rows']]
+        else:
+            rows = [MemberSnapshot(*m) for m in record['members']]
 
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(INSERT_MEMBER_SQL, member.id, member.guild.id, member.name)
+            await self._replay_rows(record, rows)
+            SPILL_REPLAYED_ROWS.inc(kind, amount=len(rows))
+            return True
+
+        except TRANSIENT_ERRORS as err:
+            logger.warning('%s %s, spill log replay postponed', type(err).__name__, err)
+            return False
 
         except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, member provocing %s', err, member)
+            logger.warning('PostgresError %s, replaying the %d rows of a spilled %s record one '
+                           'by one', err, len(rows), kind)
+
+        for row in rows:
+            try:
+                await self._replay_rows(record, [row])
+                SPILL_REPLAYED_ROWS.inc(kind)
+
+            except TRANSIENT_ERRORS as err:
+                # Rows saved already are skipped as unchanged when the record is replayed again
+                logger.warning('%s %s, spill log replay postponed', type(err).__name__, err)
+                return False
+
+            except asyncpg.PostgresError as err:
+                DB_ERRORS.inc('replay_spill')
+                logger.error('PostgresError %s, dropping spilled %s row %s', err, kind,
+                             row[0] if kind == 'messages' else row.id)
+
+        return True
+
+    async def _replay_rows(self, record: dict, rows: list) -> None:
+        """Save rows of a spilled record, messages or member snapshots"""
+
+        if record['kind'] == 'messages':
+            await self._merge_message_records(rows)
+            return
+
+        await self._save_member_updates(rows, decode_datetime(record['now']),
+                                        decode_datetime(record['utcnow']))
 
+    @timed(DB_STATEMENT_SECONDS, 'save_guild')
     async def save_guild(self, guild: discord.Guild):
         """Save member nickname to db if it has changed"""
 
         logger.debug('Saving guild %s', guild.name)
 
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(INSERT_GUILD_SQL, guild.id, guild.name)
+            async with self.acquire(WRITE) as conn:
+                written = written_rows(await conn.execute(INSERT_GUILD_SQL, guild.id,
+                                                          guild.name))
+            UPSERT_ROWS.inc('guild', 'written' if written else 'skipped')
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, guild provocing %s', err, guild)
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('save_guild')
+            logger.error('%s %s, guild provocing %s', type(err).__name__, err, guild)
+
+    @timed(DB_STATEMENT_SECONDS, 'get_member_stats')
+    async def get_member_stats(self, member: discord.Member, since: datetime.datetime,
+                               limit: int = 5) -> Optional[dict]:
+        """Get the messages per channel and the time per activity of a member since a date"""
+
+        logger.debug('Get stats of member %s', member.id)
+
+        try:
+            async with self.acquire(READ) as conn:
+                messages = await conn.fetch(MEMBER_MESSAGE_STATS_SQL, member.guild.id,
+                                            member.id, since.date(), limit)
+                activities = await conn.fetch(MEMBER_ACTIVITY_STATS_SQL, member.guild.id,
+                                              member.id, since, datetime.datetime.utcnow(),
+                                              limit)
+                return {'messages': [dict(r) for r in messages],
+                        'activities': [dict(r) for r in activities]}
+
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('get_member_stats')
+            logger.error('%s %s, member provocing %s', type(err).__name__, err, member)
+
+    @timed(DB_STATEMENT_SECONDS, 'get_guild_stats')
+    async def get_guild_stats(self, guild: discord.Guild, since: datetime.datetime,
+                              limit: int = 5) -> Optional[dict]:
+        """Get the messages per member and the time per activity of a guild since a date"""
+
+        logger.debug('Get stats of guild %s', guild.name)
+
+        try:
+            async with self.acquire(READ) as conn:
+                messages = await conn.fetch(GUILD_MESSAGE_STATS_SQL, guild.id, since.date(),
+                                            limit)
+                activities = await conn.fetch(GUILD_ACTIVITY_STATS_SQL, guild.id, since,
+                                              datetime.datetime.utcnow(), limit)
+                return {'messages': [dict(r) for r in messages],
+                        'activities': [dict(r) for r in activities]}
+
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('get_guild_stats')
+            logger.error('%s %s, guild provocing %s', type(err).__name__, err, guild)
+
+    @timed(DB_STATEMENT_SECONDS, 'search_messages')
+    async def search_messages(self, guild: discord.Guild, query: str,
+                              member: Optional[discord.abc.Snowflake] = None,
+                              channel: Optional[discord.abc.Snowflake] = None,
+                              since: Optional[datetime.datetime] = None,
+                              until: Optional[datetime.datetime] = None,
+                              before: Optional[int] = None,
+                              limit: int = SEARCH_PAGE_SIZE) -> Optional[List[dict]]:
+        """
+        Search the messages of a guild matching a web search style query, newest first
+
+        Pass the id of the last message of a page as `before` to get the next one. The date
+        range is converted to snowflake ids so that every filter is on the id order.
+        """
 
+        logger.debug('Search messages of guild %s: %s', guild.id, query)
+
+        low = discord.utils.time_snowflake(since) if since else 0
+        high = discord.utils.time_snowflake(until) if until else SNOWFLAKE_MAX
+        if before is not None:
+            high = min(high, before)
+
+        try:
+            async with self.acquire(READ) as conn:
+                records = await conn.fetch(SEARCH_MESSAGES_SQL, guild.id, query,
+                                           member.id if member else None,
+                                           channel.id if channel else None, low, high, limit)
+                return [dict(r) for r in records]
+
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('search_messages')
+            logger.error('%s %s, guild provocing %s', type(err).__name__, err, guild)
+
+    async def stream_guild_rows(self, table: str, guild_id: int, after: int,
+                                chunk_size: int) -> AsyncIterator[List[asyncpg.Record]]:
+        """
+        Yield the rows of a guild in `table` ('message' or 'activity') with an id above
+        `after`, in id order, `chunk_size` rows at a time from a server-side cursor
+        """
+
+        logger.debug('Stream %s rows of guild %s after %s', table, guild_id, after)
+
+        async with self.acquire(READ) as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(EXPORT_SQL[table], guild_id, after)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        return
+                    yield rows
+
+    @timed(DB_STATEMENT_SECONDS, 'get_member_emojis')
     async def get_member_emojis(self, guild: discord.Guild):
         """Get emojis tied to members"""
 
         logger.debug('Get member emojis of guild %s', guild.name)
 
         try:
-            async with self.pool.acquire() as conn:
+            async with self.acquire(READ) as conn:
                 records = await conn.fetch(GUILD_MEMBER_EMOJIS, guild.id)
                 return [dict(r) for r in records]
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, guild provocing %s', err, guild)
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('get_member_emojis')
+            logger.error('%s %s, guild provocing %s', type(err).__name__, err, guild)
 
+    @timed(DB_STATEMENT_SECONDS, 'get_random_messages')
     async def get_random_messages(self, guild: discord.Guild, n_messages: int):
-        """Get emojis tied to members"""
+        """
+        Get random messages of a guild with the author and its emoji
 
-        logger.debug('Get member emojis of guild %s', guild.name)
+        Messages are sampled by probing random snowflake ids between the first and last message
+        of the guild, so the cost depends on the number of messages asked, not on the size of
+        the history. Sampling is uniform over time rather than over messages.
+        """
+
+        logger.debug('Get %d random messages of guild %s', n_messages, guild.name)
 
         try:
-            async with self.pool.acquire() as conn:
-                records = await conn.fetch(RANDOM_MESSAGES, guild.id, 50, n_messages)
-                return [dict(r) for r in records]
+            async with self.acquire(READ) as conn:
+                low, high = await conn.fetchrow(GUILD_MESSAGE_ID_RANGE_SQL, guild.id)
+                sample = {}
 
-        except asyncpg.PostgresError as err:
-            logger.error('PostgresError %s, guild provocing %s', err, guild)
+                for _ in range(RANDOM_MESSAGES_ROUNDS if low is not None else 0):
+                    probes = [random.randint(low, high)
+                              for _ in range(2 * (n_messages - len(sample)))]
+                    records = await conn.fetch(RANDOM_MESSAGES, guild.id,
+                                               RANDOM_MESSAGES_MIN_LENGTH, probes)
+                    for record in records:
+                        sample.setdefault(record['message'], dict(record))
+
+                    if len(sample) >= n_messages:
+                        break
+
+            messages = list(sample.values())
+            random.shuffle(messages)
+            return messages[:n_messages]
+
+        except QUERY_ERRORS as err:
+            DB_ERRORS.inc('get_random_messages')
+            logger.error('%s %s, guild provocing %s', type(err).__name__, err, guild)
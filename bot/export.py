@@ -0,0 +1,211 @@
+"""
+Guild export
+Stream the messages and activities of a guild to gzipped JSON lines, or Parquet, files.
+
+Rows are read from a server-side cursor and written a chunk at a time, so the memory used does
+not depend on the size of the guild. After every chunk, the last exported id of the table is
+saved next to the export: running the same command again resumes where it stopped.
+
+    python export.py 123456789012345678 --out exports/ --format jsonl
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from typing import List
+
+import yaml
+
+from db import Db, EXPORT_SQL
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DEFAULT_CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def parquet_schema(table: str):
+    """Arrow schema of the exported rows of `table`"""
+
+    timestamp = pyarrow.timestamp('us')
+    if table == 'message':
+        return pyarrow.schema([('id', pyarrow.int64()), ('guild', pyarrow.int64()),
+                               ('channel', pyarrow.int64()), ('user_id', pyarrow.int64()),
+                               ('content', pyarrow.string()), ('datetime', timestamp)])
+
+    return pyarrow.schema([('id', pyarrow.int64()), ('guild', pyarrow.int64()),
+                           ('member', pyarrow.int64()), ('status', pyarrow.string()),
+                           ('type', pyarrow.string()), ('name', pyarrow.string()),
+                           ('start', timestamp), ('end', timestamp),
+                           ('listening_title', pyarrow.string()),
+                           ('listening_artist', pyarrow.string()),
+                           ('listening_album', pyarrow.string()),
+                           ('listening_track_id', pyarrow.string()),
+                           ('listening_party', pyarrow.string())])
+
+
+def json_default(value):
+    """Serialize the values json does not know, datetimes of the rows"""
+
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class Checkpoint:
+    """Last exported id of a table, saved in a sidecar file of the export"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> int:
+        """Last exported id, 0 if nothing was exported yet"""
+
+        try:
+            with open(self.path, 'r') as checkpoint_file:
+                return int(checkpoint_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def save(self, last_id: int) -> None:
+        """Atomically replace the saved id"""
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            checkpoint_file.write(f'{last_id}\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class JsonLinesWriter:
+    """
+    Append chunks to a gzipped JSON lines file
+    Every chunk is a complete gzip member, so an interrupted export leaves a readable file
+    """
+
+    def __init__(self, path: str, table: str):
+        self.path = path + '.jsonl.gz'
+
+    def write(self, rows: List) -> None:
+        with gzip.open(self.path, 'at', encoding='utf-8') as export_file:
+            for row in rows:
+                export_file.write(json.dumps(dict(row), default=json_default,
+                                             ensure_ascii=False))
+                export_file.write('\n')
+
+    def close(self) -> None:
+        pass
+
+
+class ParquetWriter:
+    """
+    Write chunks as row groups of a Parquet file
+    Parquet files can not be appended to, a resumed export writes a new part file
+    """
+
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.schema = parquet_schema(table)
+        self.writer = None
+
+    def write(self, rows: List) -> None:
+        if self.writer is None:
+            part = f'{self.path}.{rows[0]["id"]}.parquet'
+            self.writer = pyarrow.parquet.ParquetWriter(part, self.schema)
+
+        columns = {name: [row[name] for row in rows] for name in self.schema.names}
+        self.writer.write_table(pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'parquet': ParquetWriter,
+}
+
+
+async def export_table(database: Db, table: str, guild_id: int, args: argparse.Namespace) -> int:
+    """Export the rows of a guild in `table` after the checkpoint, return the exported count"""
+
+    path = os.path.join(args.out, f'{guild_id}.{table}')
+    checkpoint = Checkpoint(f'{path}.{args.format}.checkpoint')
+    after = args.after if args.after is not None else checkpoint.load()
+    writer = WRITERS[args.format](path, table)
+
+    logger.info('Export %s of guild %s after id %s', table, guild_id, after)
+
+    exported = 0
+    start = time.perf_counter()
+
+    try:
+        async for rows in database.stream_guild_rows(table, guild_id, after, args.chunk_size):
+            writer.write(rows)
+            # Rows are written before the checkpoint moves, at worst a chunk is exported twice
+            checkpoint.save(rows[-1]['id'])
+            exported += len(rows)
+            logger.info('%s: %d rows, last id %s, %.0f rows/s', table, exported, rows[-1]['id'],
+                        exported / (time.perf_counter() - start))
+    finally:
+        writer.close()
+
+    return exported
+
+
+async def main(args: argparse.Namespace) -> int:
+    """Connect to db and export every requested table"""
+
+    if args.format == 'parquet' and pyarrow is None:
+        logger.error('Parquet export requires pyarrow')
+        return 1
+
+    with open('../config/config.yml', 'r') as config_file:
+        config = yaml.load(config_file, Loader=yaml.BaseLoader)
+
+    os.makedirs(args.out, exist_ok=True)
+
+    database = Db(config)
+    await database.connect_db()
+
+    try:
+        for table in args.tables:
+            exported = await export_table(database, table, args.guild, args)
+            logger.info('%s: exported %d rows', table, exported)
+    finally:
+        await database.close()
+
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    """Export options"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('guild', type=int, help='id of the guild to export')
+    parser.add_argument('--out', default='exports', help='directory of the export files')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='jsonl')
+    parser.add_argument('--tables', nargs='+', choices=sorted(EXPORT_SQL),
+                        default=['message', 'activity'])
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='rows fetched from the cursor and written at a time')
+    parser.add_argument('--after', type=int,
+                        help='export the rows after this id instead of the saved checkpoint')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(parse_args())))
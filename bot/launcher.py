@@ -3,20 +3,83 @@ Launcher module
 Entry point of the bot
 """
 
+import atexit
 import logging
 import logging.handlers
+import math
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+from typing import List, Optional
 
 import asyncio
-import asyncpg
+import discord
 import yaml
-from discord.ext.commands import Bot
+from discord.ext.commands import AutoShardedBot, Bot
 
-from db import Db
+import metrics
+from db import QUERY_ERRORS, Db
 from quiadit import QuiADit
-from scrapper import Scrapper
+from scrapper import Scrapper, low_memory
+from search import Search
+from stats import Stats
 
+SUPERVISE_INTERVAL = 1  # seconds between checks of the worker processes
+RESTART_MAX_DELAY = 300  # seconds, upper bound of the restart backoff
+HEALTHY_UPTIME = 600  # seconds a worker must run before its restart backoff is reset
 
-def setup_logging():
+# Cached members in low memory mode, members that are offline are not tracked by discord.py
+LOW_MEMORY_MEMBER_CACHE = 'online'
+
+# Records per second let through below WARNING for loggers of per-event lines
+LOG_RATE_LIMITS = {
+    'db': 50,
+    'scrapper': 50,
+}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `rate` records per second below WARNING, with bursts of `rate` records
+
+    The number of dropped records is appended to the next record let through.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+
+        self.tokens -= 1
+        if self.dropped:
+            record.msg = f'{record.msg} [{self.dropped} records dropped]'
+            self.dropped = 0
+        return True
+
+
+def setup_logging(log_name: str = 'staticord'):
+    """
+    Log to files from a background thread
+
+    Loggers only put records in a queue, the files are written by a listener thread so that
+    file I/O does not block the event loop.
+    """
     logging.getLogger('discord').setLevel(logging.INFO)
     logging.getLogger('db').setLevel(logging.DEBUG)
     logging.getLogger('quiadit').setLevel(logging.DEBUG)
@@ -33,42 +96,201 @@ def setup_logging():
     debug_handler = logging.handlers.TimedRotatingFileHandler(when="midnight",
                                                               backupCount=30,
                                                               interval=1,
-                                                              filename='../logs/staticord.log',
+                                                              filename=f'../logs/{log_name}.log',
                                                               encoding='utf-8')
     debug_handler.setFormatter(fmt)
-    logger.addHandler(debug_handler)
 
     # Error logging
-    error_handler = logging.FileHandler('../logs/error.log')
+    error_log_name = 'error' if log_name == 'staticord' else f'{log_name}-error'
+    error_handler = logging.FileHandler(f'../logs/{error_log_name}.log')
     error_handler.setLevel(logging.ERROR)
     error_handler.setFormatter(fmt)
-    logger.addHandler(error_handler)
 
+    log_queue = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, debug_handler, error_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for name, rate in LOG_RATE_LIMITS.items():
+        logging.getLogger(name).addFilter(RateLimitFilter(rate))
 
-def run_bot():
+
+def load_config() -> dict:
+    """Load config file"""
+
+    with open('../config/config.yml', 'r') as config_file:
+        return yaml.load(config_file, Loader=yaml.BaseLoader)
+
+
+def bot_options(config: dict) -> dict:
+    """
+    Intents and member cache options of the bot
+
+    Member and presence intents are needed to track members, other intents can be turned off
+    in the intents section of the config. In low memory mode, only the members listed in
+    member_cache are cached and guilds are not chunked at startup.
+    """
+
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.presences = True
+    for name, value in config['bot'].get('intents', {}).items():
+        setattr(intents, name, value.lower() == 'true')
+
+    options = {'intents': intents}
+    if low_memory(config):
+        flags = config['bot'].get('member_cache', LOW_MEMORY_MEMBER_CACHE)
+        options['member_cache_flags'] = discord.MemberCacheFlags.none()
+        for flag in filter(None, (flag.strip() for flag in flags.split(','))):
+            setattr(options['member_cache_flags'], flag, True)
+        options['chunk_guilds_at_startup'] = False
+
+    return options
+
+
+def run_bot(config: dict, shard_ids: Optional[List[int]] = None, worker: int = 0):
     """
-    Load config, connect to database, initialize and launch bot
+    Connect to database, initialize and launch bot
+
+    With a shard count above one, the bot runs the given shards, or all of them if no
+    shard ids are given.
     """
     loop = asyncio.get_event_loop()
     logger = logging.getLogger(__name__)
 
-    with open('../config/config.yml', 'r') as config_file:
-        config = yaml.load(config_file, Loader=yaml.BaseLoader)
-
     try:
-        db = Db(config)
+        db = Db(config, worker)
         loop.run_until_complete(db.connect_db())
-    except asyncpg.PostgresError as err:
-        logger.error('Cannot connect to database: %s', err)
-        return
+    except QUERY_ERRORS as err:
+        logger.error('Cannot connect to database: %s %s', type(err).__name__, err)
+        sys.exit(1)
+
+    if 'metrics' in config:
+        loop.run_until_complete(metrics.start_server(config['metrics'].get('host', '127.0.0.1'),
+                                                     int(config['metrics']['port']) + worker))
+
+    shard_count = int(config['bot'].get('shard_count', 1))
+    if shard_count > 1:
+        logger.info('Running shards %s of %d', shard_ids or 'all', shard_count)
+        bot = AutoShardedBot(command_prefix=config['bot']['prefix'], shard_count=shard_count,
+                             shard_ids=shard_ids, **bot_options(config))
+    else:
+        bot = Bot(command_prefix=config['bot']['prefix'], **bot_options(config))
 
-    bot = Bot(command_prefix=config['bot']['prefix'])
     bot.db = db
     bot.add_cog(Scrapper(bot))
     bot.add_cog(QuiADit(bot))
-    bot.run(config['bot']['token'])
+    bot.add_cog(Stats(bot))
+    bot.add_cog(Search(bot))
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+    except NotImplementedError:
+        pass
+
+    try:
+        loop.run_until_complete(bot.start(config['bot']['token']))
+    except KeyboardInterrupt:
+        logger.info('Interrupted, shutting down')
+    finally:
+        loop.run_until_complete(bot.close())
+        loop.run_until_complete(db.close())
+        loop.close()
+
+
+def shard_ranges(shard_count: int, workers: int) -> List[List[int]]:
+    """Split shards in contiguous ranges, one per worker"""
+
+    per_worker = math.ceil(shard_count / workers)
+    return [list(range(start, min(start + per_worker, shard_count)))
+            for start in range(0, shard_count, per_worker)]
+
+
+def run_worker(worker: int, shard_ids: List[int]):
+    """Entry point of a worker process"""
+
+    setup_logging(f'staticord-{worker}')
+    run_bot(load_config(), shard_ids=shard_ids, worker=worker)
+
+
+def supervise(config: dict):
+    """
+    Run the shards of the bot in several worker processes
+
+    Workers exiting with an error are restarted with an exponential backoff, the supervisor
+    stops every worker on SIGTERM or SIGINT.
+    """
+    logger = logging.getLogger(__name__)
+    context = multiprocessing.get_context('spawn')
+    ranges = shard_ranges(int(config['bot']['shard_count']), int(config['bot']['workers']))
+
+    processes = {}
+    started = {}
+    restarts = {worker: 0 for worker in range(len(ranges))}
+    next_start = {worker: 0.0 for worker in range(len(ranges))}
+    stopping = []
+
+    def stop(*_):
+        stopping.append(True)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while not stopping:
+            now = time.monotonic()
+
+            for worker, shard_ids in enumerate(ranges):
+                process = processes.get(worker)
+
+                if process and not process.is_alive():
+                    if process.exitcode == 0:
+                        logger.info('Worker %d stopped', worker)
+                        stop()
+                        break
+
+                    if now - started[worker] > HEALTHY_UPTIME:
+                        restarts[worker] = 0
+                    delay = min(RESTART_MAX_DELAY, 2 ** restarts[worker])
+                    restarts[worker] += 1
+                    next_start[worker] = now + delay
+                    logger.error('Worker %d (shards %s) exited with code %s, restarting in %d '
+                                 'seconds', worker, shard_ids, process.exitcode, delay)
+                    processes[worker] = process = None
+
+                if not process and now >= next_start[worker]:
+                    logger.info('Starting worker %d with shards %s', worker, shard_ids)
+                    processes[worker] = context.Process(target=run_worker,
+                                                        args=(worker, shard_ids),
+                                                        name=f'staticord-{worker}')
+                    processes[worker].start()
+                    started[worker] = now
+
+            time.sleep(SUPERVISE_INTERVAL)
+
+    finally:
+        for process in processes.values():
+            if process and process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            if process:
+                process.join()
+
+
+def main():
+    """Run the bot in this process, or supervise worker processes"""
+
+    config = load_config()
+
+    if int(config['bot'].get('workers', 1)) > 1:
+        setup_logging('staticord-supervisor')
+        supervise(config)
+    else:
+        setup_logging()
+        run_bot(config)
 
 
 if __name__ == '__main__':
-    setup_logging()
-    run_bot()
+    main()
@@ -0,0 +1,155 @@
+"""
+Member state cache
+Keeps the last saved name, nickname and activity of every member to detect changes without
+querying the database
+"""
+import datetime
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import discord
+
+# Marks a name, nickname or activity that has never been saved for a member
+MISSING = object()
+
+NAME, NICKNAME, ACTIVITY, OPEN_ACTIVITY = range(4)
+UNKNOWN_STATE = (MISSING, MISSING, MISSING, None)
+
+
+def activity_state(member: discord.Member) -> tuple:
+    """Normalized activity of a member, with the compared columns of staticord.activity"""
+
+    if isinstance(member, MemberSnapshot):
+        return member.activity_state
+
+    activity = member.activity
+    spotify = isinstance(activity, discord.Spotify)
+
+    return (member.status.value,
+            activity.type.name if activity else None,
+            activity.name if activity else None,
+            activity.title if spotify else None,
+            activity.artist if spotify else None,
+            activity.album if spotify else None,
+            activity.track_id if spotify else None,
+            activity.party_id if spotify else None)
+
+
+def activity_row_state(row) -> tuple:
+    """Normalized activity of a staticord.activity row"""
+
+    return (row['status'], row['type'], row['name'], row['listening_title'],
+            row['listening_artist'], row['listening_album'], row['listening_track_id'],
+            row['listening_party'])
+
+
+class MemberSnapshot:
+    """
+    Saved fields of a member, standing for the member in the Db member methods
+
+    Snapshots are written to the spill log as lists and replayed when the database is back.
+    """
+
+    __slots__ = ('id', 'guild', 'name', 'nick', 'activity_state')
+
+    def __init__(self, guild_id: int, member_id: int, name: str, nick, state):
+        self.id = member_id
+        self.guild = discord.Object(guild_id)
+        self.name = name
+        self.nick = nick
+        self.activity_state = tuple(state)
+
+    @classmethod
+    def from_member(cls, member: discord.Member) -> 'MemberSnapshot':
+        """Snapshot of the current state of a member"""
+        return cls(member.guild.id, member.id, member.name, member.nick, activity_state(member))
+
+    def to_list(self) -> list:
+        """JSON serializable fields, the arguments of the constructor"""
+        return [self.guild.id, self.id, self.name, self.nick, list(self.activity_state)]
+
+
+class MemberStateCache:
+    """
+    Last saved (name, nickname, activity, open activity interval) of members, keyed by
+    (guild, member)
+    """
+
+    def __init__(self):
+        self.states: Dict[Tuple[int, int], Tuple] = {}
+        self.guilds: Set[int] = set()
+
+    def load(self, guild_id: int, nicknames: Iterable, activities: Iterable) -> None:
+        """Fill the cache of a guild from its latest nickname and activity rows"""
+
+        self.guilds.add(guild_id)
+        for key in [key for key in self.states if key[0] == guild_id]:
+            del self.states[key]
+
+        for row in nicknames:
+            self.states[(guild_id, row['member'])] = (MISSING, row['nickname'], MISSING, None)
+
+        for row in activities:
+            key = (guild_id, row['member'])
+            name, nickname, _, _ = self.states.get(key, UNKNOWN_STATE)
+            interval = (row['id'], row['start']) if row['end'] is None else None
+            self.states[key] = (name, nickname, activity_row_state(row), interval)
+
+    def _get(self, member: discord.Member, field: int):
+        return self.states.get((member.guild.id, member.id), UNKNOWN_STATE)[field]
+
+    def _set(self, member: discord.Member, values: Dict[int, object]) -> None:
+        key = (member.guild.id, member.id)
+        state = list(self.states.get(key, UNKNOWN_STATE))
+        for field, value in values.items():
+            state[field] = value
+        self.states[key] = tuple(state)
+
+    def name_changed(self, member: discord.Member) -> bool:
+        """Whether the member row of a member differs from the saved one"""
+
+        name = self._get(member, NAME)
+        return name is MISSING or name != member.name
+
+    def nickname_changed(self, member: discord.Member) -> bool:
+        """Whether the nickname of a member differs from the saved one"""
+
+        nickname = self._get(member, NICKNAME)
+        if nickname is MISSING:
+            return member.nick is not None
+        return nickname != member.nick
+
+    def activity_changed(self, member: discord.Member) -> bool:
+        """Whether the activity of a member differs from the saved one"""
+
+        activity = self._get(member, ACTIVITY)
+        return activity is MISSING or activity != activity_state(member)
+
+    def set_name(self, member: discord.Member) -> None:
+        """Record the member row of a member as saved"""
+        self._set(member, {NAME: member.name})
+
+    def set_nickname(self, member: discord.Member) -> None:
+        """Record the nickname of a member as saved"""
+        self._set(member, {NICKNAME: member.nick})
+
+    def open_activity(self, member: discord.Member) -> Optional[Tuple[int, datetime.datetime]]:
+        """(id, start) of the open activity interval of a member, if any"""
+        return self._get(member, OPEN_ACTIVITY)
+
+    def open_activities(self, guild_id: int) -> Dict[int, Tuple[int, datetime.datetime]]:
+        """(id, start) of the open activity intervals of a guild, by member id"""
+        return {key[1]: state[OPEN_ACTIVITY] for key, state in self.states.items()
+                if key[0] == guild_id and state[OPEN_ACTIVITY]}
+
+    def close_activity(self, guild_id: int, member_id: int) -> None:
+        """Record the activity interval of a member as closed, the next activity opens one"""
+
+        key = (guild_id, member_id)
+        if key in self.states:
+            name, nickname, _, _ = self.states[key]
+            self.states[key] = (name, nickname, MISSING, None)
+
+    def set_activity(self, member: discord.Member,
+                     interval: Tuple[int, datetime.datetime]) -> None:
+        """Record the activity of a member as saved in the open interval (id, start)"""
+        self._set(member, {ACTIVITY: activity_state(member), OPEN_ACTIVITY: interval})
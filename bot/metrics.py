@@ -0,0 +1,203 @@
+"""
+Metrics module
+Counters, gauges and histograms kept in memory and served in Prometheus text format
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from typing import Dict, List, Sequence, Tuple
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    """Base class of metrics, values are keyed by the tuple of their label values"""
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple, object] = {}
+
+    def render(self) -> List[str]:
+        """Lines of the metric in Prometheus text format"""
+
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for label_values, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labels, label_values),
+                                          value))
+        return lines
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        """Increment the counter of the given label values"""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+
+    type = 'gauge'
+
+    def set(self, value: float, *labels) -> None:
+        """Set the gauge of the given label values"""
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in fixed buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        """Record a value for the given label values"""
+
+        state = self.values.get(labels)
+        if state is None:
+            # Per bucket counts (the last one is +Inf), sum, count
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        bucket_labels = self.labels + ('le',)
+
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(bucket_labels, label_values + (bound,)),
+                    cumulative))
+            labels = _format_labels(self.labels, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+
+        return lines
+
+
+class Registry:
+    """Set of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric to the registry and return it"""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Every metric in Prometheus text format"""
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+DB_STATEMENT_SECONDS = REGISTRY.register(Histogram(
+    'staticord_db_statement_seconds', 'Duration of Db methods', ['statement']))
+DB_ERRORS = REGISTRY.register(Counter(
+    'staticord_db_errors_total', 'Query errors raised in Db methods', ['statement']))
+DB_POOL_ACQUIRE_SECONDS = REGISTRY.register(Histogram(
+    'staticord_db_pool_acquire_seconds', 'Time waited to acquire a pool connection', ['pool']))
+DB_POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    'staticord_db_pool_connections', 'Open, idle and maximum connections of a pool',
+    ['pool', 'state']))
+DB_POOL_WAITING = REGISTRY.register(Gauge(
+    'staticord_db_pool_waiting', 'Queries waiting for a free connection of a pool', ['pool']))
+DB_REPLICA_LAG_SECONDS = REGISTRY.register(Gauge(
+    'staticord_db_replica_lag_seconds', 'Replication lag of the replica at the last check'))
+DB_REPLICA_HEALTHY = REGISTRY.register(Gauge(
+    'staticord_db_replica_healthy', 'Whether reads are sent to the replica'))
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    'staticord_handler_seconds', 'Duration of event listeners', ['event']))
+BACKFILL_ROWS = REGISTRY.register(Counter(
+    'staticord_backfill_rows_total', 'Messages fetched by history backfill',
+    ['guild', 'channel']))
+BACKFILL_ROWS_PER_SECOND = REGISTRY.register(Gauge(
+    'staticord_backfill_rows_per_second', 'Backfill throughput of the last batch of a channel',
+    ['guild', 'channel']))
+BACKFILL_CHANNELS = REGISTRY.register(Gauge(
+    'staticord_backfill_channels', 'Channels queued, running and done by the backfill scheduler',
+    ['state']))
+SPILLED_ROWS = REGISTRY.register(Counter(
+    'staticord_spilled_rows_total', 'Rows of failed writes appended to the spill log',
+    ['kind']))
+SPILL_REPLAYED_ROWS = REGISTRY.register(Counter(
+    'staticord_spill_replayed_rows_total', 'Rows of the spill log saved to the database',
+    ['kind']))
+UPSERT_ROWS = REGISTRY.register(Counter(
+    'staticord_upsert_rows_total', 'Rows of upserts written, or skipped as unchanged',
+    ['table', 'result']))
+
+
+def timed(histogram: Histogram, *labels):
+    """Decorator observing the duration of a coroutine function in a histogram"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+
+        return wrapper
+
+    return decorator
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        # Every request is answered with the metrics, headers are read and ignored
+        while (await reader.readline()).strip():
+            pass
+
+        body = REGISTRY.render().encode('utf-8')
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n'
+                     b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    except ConnectionError as err:
+        logger.debug('Metrics client disconnected: %s', err)
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    """Serve the metrics over HTTP"""
+
+    logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return await asyncio.start_server(_handle_request, host, port)
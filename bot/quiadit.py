@@ -5,88 +5,180 @@ This is a game to guess who said a message chosen randomly in the database
 
 import logging
 import asyncio
+from collections import deque
+from typing import Dict, Optional
 
 import discord
 from discord.ext import commands
 
+N_QUESTIONS = 40
+QUESTION_BATCH = 5  # questions fetched from db at once
+ANSWER_TIMEOUT = 20  # seconds
+QUESTION_INTERVAL = 10  # seconds
+REACTION_CONCURRENCY = 4  # reactions added to a question at the same time
+
 logger = logging.getLogger(__name__)
 
 
-class QuiADit(commands.Cog):
-    """Poll voting system."""
+class QuiADitGame:
+    """
+    A game of QuiADit in a guild
 
-    def __init__(self, bot):
+    The game runs in its own task. The next question is fetched while the current one is
+    live, and answers are accepted while reactions are still being added.
+    """
+
+    def __init__(self, bot, ctx, n_questions: int = N_QUESTIONS):
         self.bot = bot
+        self.ctx = ctx
+        self.n_questions = n_questions
+        self.emojis = []
+        self.questions = deque()
+        self.asked = set()
+        self.task: Optional[asyncio.Task] = None
 
-    @commands.command()
-    @commands.guild_only()
-    async def quiadit(self, ctx):
-        """
-        Launch QuiADit game
-
-        TODO: refactor
-        """
-
-        member_emojis = await self.bot.db.get_member_emojis(ctx.guild)
-        all_emojis = ctx.guild.emojis
-
-        for member_emoji in member_emojis:
-            emoji_of_member = [e for e in all_emojis if e.name == member_emoji['emoji']]
-            emoji_of_member = emoji_of_member[0] if emoji_of_member else member_emoji['emoji']
-            member_emoji['object'] = emoji_of_member
-
-        # a list of messages to delete when we're all done
-        questions = await self.bot.db.get_random_messages(ctx.guild, 40)
-        i = 0
-        for q in questions:
-            i = i + 1
-            question = q['content']
-            answer = q['emoji']
-            answer_name = q['name']
-
-            question_message: discord.Message = await ctx.send(
-                f'**Qui a dit ? ({i}/{len(questions)})**'
-                f'\n**-------------------------------------------**'
-                f'\n'
-                f'\n{question}'
-                f'\n'
-                f'\n**-------------------------------------------**')
-
-            for emoji in member_emojis:
+    def start(self) -> None:
+        """Start the game in the background"""
+        self.task = self.bot.loop.create_task(self.run())
+
+    def stop(self) -> None:
+        """Cancel the game"""
+        if self.task:
+            self.task.cancel()
+
+    async def run(self) -> None:
+        """Play every question of the game"""
+
+        upcoming = self.bot.loop.create_task(self.next_question())
+
+        try:
+            await self.load_emojis()
+
+            for i in range(1, self.n_questions + 1):
+                question = await upcoming
+                if not question:
+                    break
+
+                upcoming = self.bot.loop.create_task(self.next_question())
+                await self.ask(i, question)
+                await asyncio.sleep(QUESTION_INTERVAL)
+
+        except asyncio.CancelledError:
+            logger.info('QuiADit game of guild %s cancelled', self.ctx.guild.name)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.exception('Error in QuiADit game of guild %s: %s', self.ctx.guild.name, err)
+        finally:
+            upcoming.cancel()
+
+    async def load_emojis(self) -> None:
+        """Resolve the emoji of every member to a guild emoji, or keep it as text"""
+
+        member_emojis = await self.bot.db.get_member_emojis(self.ctx.guild) or []
+        emoji_index = {emoji.name: emoji for emoji in self.ctx.guild.emojis}
+        self.emojis = [emoji_index.get(e['emoji'], e['emoji']) for e in member_emojis]
+
+    async def next_question(self) -> Optional[dict]:
+        """Get a question that was not asked yet, fetching a new batch if needed"""
+
+        if not self.questions:
+            messages = await self.bot.db.get_random_messages(self.ctx.guild,
+                                                             QUESTION_BATCH) or []
+            self.questions.extend(m for m in messages if m['message'] not in self.asked)
+
+        if not self.questions:
+            return None
+
+        question = self.questions.popleft()
+        self.asked.add(question['message'])
+        return question
+
+    async def add_reactions(self, message: discord.Message) -> None:
+        """Add every member emoji to a question, a few at a time"""
+
+        semaphore = asyncio.Semaphore(REACTION_CONCURRENCY)
+
+        async def add_reaction(emoji):
+            async with semaphore:
                 try:
-                    self.bot.loop.create_task(await question_message.add_reaction(emoji['object']))
+                    await message.add_reaction(emoji)
                 except discord.DiscordException as err:
-                    logger.error('Error while adding reaction %s: %s', emoji['object'], err)
+                    logger.error('Error while adding reaction %s: %s', emoji, err)
+
+        await asyncio.gather(*(add_reaction(emoji) for emoji in self.emojis))
+
+    async def ask(self, i: int, question: dict) -> None:
+        """Send a question and wait for the right answer"""
 
-            losers = []
+        answer = question['emoji']
+        answer_name = question['name']
 
-            check = lambda _reaction, _user, message=question_message, _losers=losers: \
-                _reaction.message.id == message.id and _user not in _losers and not _user.bot
+        question_message: discord.Message = await self.ctx.send(
+            f'**Qui a dit ? ({i}/{self.n_questions})**'
+            f'\n**-------------------------------------------**'
+            f'\n'
+            f'\n{question["content"]}'
+            f'\n'
+            f'\n**-------------------------------------------**')
 
+        reactions = self.bot.loop.create_task(self.add_reactions(question_message))
+        losers = []
+
+        check = lambda _reaction, _user, message=question_message, _losers=losers: \
+            _reaction.message.id == message.id and _user not in _losers and not _user.bot
+
+        try:
             while True:
                 try:
-                    reaction, user = await self.bot.wait_for('reaction_add', timeout=20,
+                    reaction, user = await self.bot.wait_for('reaction_add',
+                                                             timeout=ANSWER_TIMEOUT,
                                                              check=check)
                     emoji_text = reaction.emoji.name if isinstance(reaction.emoji, discord.Emoji) \
                         else reaction.emoji
 
                     if emoji_text == answer:
-                        await ctx.send(f'{user.mention} win :sanic: '
-                                       f'\n'
-                                       f'\n**Response was** {answer_name}:'
-                                       f'\n**---**')
+                        await self.ctx.send(f'{user.mention} win :sanic: '
+                                            f'\n'
+                                            f'\n**Response was** {answer_name}:'
+                                            f'\n**---**')
                         break
                     else:
                         losers.append(user)
 
                 except asyncio.TimeoutError:
-                    await ctx.send(f'**Time expired** '
-                                   f'\n'
-                                   f'\n**Response was** {answer_name}:'
-                                   f'\n**---**')
+                    await self.ctx.send(f'**Time expired** '
+                                        f'\n'
+                                        f'\n**Response was** {answer_name}:'
+                                        f'\n**---**')
                     break
+        finally:
+            reactions.cancel()
+
+
+class QuiADit(commands.Cog):
+    """Poll voting system."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.games: Dict[int, QuiADitGame] = {}
+
+    def cog_unload(self):
+        """Cancel running games"""
+        for game in self.games.values():
+            game.stop()
+
+    @commands.command()
+    @commands.guild_only()
+    async def quiadit(self, ctx):
+        """Launch QuiADit game"""
+
+        game = self.games.get(ctx.guild.id)
+        if game and not game.task.done():
+            await ctx.send('**A game of Qui a dit ? is already running**')
+            return
 
-            await asyncio.sleep(10)
+        game = QuiADitGame(self.bot, ctx)
+        self.games[ctx.guild.id] = game
+        game.start()
 
     @quiadit.error
     async def poll_error(self, ctx, error):
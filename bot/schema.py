@@ -0,0 +1,82 @@
+"""
+Schema module
+Apply the versioned migrations of bot/sql to the database
+"""
+import logging
+import os
+import re
+from typing import List, Tuple
+
+import asyncpg
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Key of the advisory lock held while migrating, so that several bots do not race
+MIGRATION_LOCK_KEY = 0x57A71C0D
+
+CREATE_SCHEMA_VERSION_SQL = """
+CREATE SCHEMA IF NOT EXISTS staticord;
+CREATE TABLE IF NOT EXISTS staticord.schema_version (
+    version integer PRIMARY KEY,
+    name text NOT NULL,
+    applied_at timestamp NOT NULL DEFAULT now()
+);
+"""
+
+LOCK_MIGRATIONS_SQL = """
+SELECT pg_advisory_xact_lock($1)
+"""
+
+APPLIED_VERSIONS_SQL = """
+SELECT version FROM staticord.schema_version
+"""
+
+INSERT_SCHEMA_VERSION_SQL = """
+INSERT INTO staticord.schema_version (version, name)
+    VALUES ($1, $2)
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def load_migrations() -> List[Tuple[int, str, str]]:
+    """List (version, name, sql) of every migration file, sorted by version"""
+
+    migrations = []
+    for filename in os.listdir(SQL_DIR):
+        match = MIGRATION_FILE_PATTERN.match(filename)
+        if match:
+            with open(os.path.join(SQL_DIR, filename), 'r', encoding='utf-8') as sql_file:
+                migrations.append((int(match.group(1)), match.group(2), sql_file.read()))
+
+    return sorted(migrations)
+
+
+async def migrate(pool: asyncpg.pool.Pool) -> int:
+    """
+    Apply every migration that is not applied yet, each in its own transaction, return the
+    number of migrations applied
+    """
+
+    n_applied = 0
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.fetchval(LOCK_MIGRATIONS_SQL, MIGRATION_LOCK_KEY)
+            await conn.execute(CREATE_SCHEMA_VERSION_SQL)
+
+        for version, name, sql in load_migrations():
+            async with conn.transaction():
+                await conn.fetchval(LOCK_MIGRATIONS_SQL, MIGRATION_LOCK_KEY)
+                applied = {r['version'] for r in await conn.fetch(APPLIED_VERSIONS_SQL)}
+                if version in applied:
+                    continue
+
+                logger.info('Applying migration %04d %s', version, name)
+                await conn.execute(sql)
+                await conn.execute(INSERT_SCHEMA_VERSION_SQL, version, name)
+                n_applied += 1
+
+    logger.debug('Database schema is up to date')
+    return n_applied
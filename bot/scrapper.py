@@ -8,53 +8,104 @@ from discord.ext import commands
 
 import discord
 
+from backfill import BACKFILL_CONCURRENCY, BACKFILL_REQUESTS_PER_SECOND, BackfillScheduler
+from metrics import HANDLER_SECONDS, timed
+
 REFRESH_RATE = 60  # seconds
+MEMBER_SYNC_BATCH_SIZE = 1000  # members fetched from the API saved at once in low memory mode
 
 logger = logging.getLogger(__name__)
 
 
+def low_memory(config: dict) -> bool:
+    """Whether the bot caches only some members and fetches the others when syncing guilds"""
+    return config['bot'].get('low_memory', 'false').lower() == 'true'
+
+
 class Scrapper(commands.Cog):
     """Poll voting system."""
 
     def __init__(self, bot):
         self.bot = bot
+        self.low_memory = low_memory(bot.db.config)
+
+        backfill_config = bot.db.config['bot'].get('backfill', {})
+        self.backfill = BackfillScheduler(
+            bot.db,
+            concurrency=int(backfill_config.get('concurrency', BACKFILL_CONCURRENCY)),
+            requests_per_second=float(backfill_config.get('requests_per_second',
+                                                          BACKFILL_REQUESTS_PER_SECOND)))
+
+    def cog_unload(self):
+        """Cancel the running backfills"""
+        self.backfill.close()
 
     @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_ready')
     async def on_ready(self) -> None:
         """Log when ready"""
         logger.info('Logged in as %s (id = %s)', self.bot.user.name, self.bot.user.id)
         await self.save_guilds_data()
 
     @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_message')
     async def on_message(self, message):
         """Called on message"""
-        logger.info('Save received message %s', message)
-        await self.bot.db.save_mesage(message)
+        logger.info('Save received message %s from %s', message.id, message.author.id)
+        await self.bot.db.queue_message(message)
+
+    @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_raw_message_edit')
+    async def on_raw_message_edit(self, payload):
+        """Called on message edit, cached or not"""
+        logger.debug('Save edited message %s', payload.message_id)
+        await self.bot.db.queue_message_edit(payload)
 
     @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_member_join')
     async def on_member_join(self, member):
         """Called on member join"""
-        logger.info('Save new member %s', member)
-        await self.save_member(member)
+        if not member.bot:
+            logger.info('Save new member %s', member.id)
+            await self.bot.db.save_member_updates([member])
+
+    @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_member_remove')
+    async def on_member_remove(self, member):
+        """Called on member leave, kick or ban"""
+        if not member.bot:
+            logger.info('Close activity of removed member %s', member.id)
+            await self.bot.db.close_member_activities(member.guild, [member.id])
 
     @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_member_update')
     async def on_member_update(self, _, member):
         """Called on member update"""
-        logger.info('Save updated member %s', member)
-        await self.save_member(member)
+        if not member.bot:
+            logger.debug('Queue updated member %s', member.id)
+            self.bot.db.queue_member_update(member)
 
     @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_guild_update')
     async def on_guild_update(self, _, guild):
         """Called on guild update"""
         logger.info('Save updated guild data %s', guild)
         await self.save_guild_data(guild)
 
     @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_guild_join')
     async def on_guild_join(self, guild):
         """Called on guild join"""
         logger.info('Save joined guild data %s', guild)
         await self.save_guild_data(guild)
 
+    @commands.Cog.listener()
+    @timed(HANDLER_SECONDS, 'on_guild_remove')
+    async def on_guild_remove(self, guild):
+        """Called on guild leave"""
+        logger.info('Close activities of removed guild %s', guild)
+        await self.bot.db.close_member_activities(guild)
+
     async def save_guilds_data(self) -> None:
         """Fetch data (message + members) from all guilds"""
 
@@ -62,7 +113,7 @@ class Scrapper(commands.Cog):
             await self.save_guild_data(guild)
 
     async def save_guild_data(self, guild: discord.Guild) -> None:
-        """Fetch data (messages + members) from one guild"""
+        """Fetch data from one guild, its messages are backfilled in the background"""
 
         logger.info('Fetching members, message and activities from channels of guild %s',
                     guild.name)
@@ -72,51 +123,37 @@ class Scrapper(commands.Cog):
         await self.save_channels_messages(guild)
 
     async def save_channels_messages(self, guild: discord.Guild) -> None:
-        """Fetch messages from all channels of a guild"""
-
-        for channel in guild.text_channels:
-            await self.save_text_channel_data(channel)
-
-    async def save_text_channel_data(self, channel: discord.TextChannel) -> None:
-        """Fetch messages from channel"""
-
-        permissions = channel.permissions_for(channel.guild.me)
-        if permissions.read_message_history:
-            logger.info('Fetching message history from channels from guild %s, channel %s',
-                        channel.guild.name, channel.name)
-
-            channel_last_message_date = await self.bot.db.get_channel_last_saved_message_date(
-                channel)
+        """Schedule the backfill of all channels of a guild"""
 
-            async for message in channel.history(limit=None,
-                                                 after=channel_last_message_date,
-                                                 reverse=True):
-                await self.bot.db.save_mesage(message)
+        await self.backfill.schedule(guild.text_channels)
 
     async def save_members(self, guild: discord.Guild):
-        """Save all members of a guild"""
-        for member in guild.members:
-            await self.save_member(member)
-
-    async def save_member(self, member: discord.Member):
-        """Save a particular member with its current nickname and activity"""
-        if not member.bot:
-            await self.bot.db.save_member(member)
-            await self.save_member_activity(member)
-            await self.save_member_nickname(member)
-
-    async def save_member_activity(self, member: discord.Member):
-        """Save member activity if it has changed"""
-        last_member_activity = await self.bot.db.get_member_last_activity(member)
-
-        if last_member_activity != member.activity:
-            logger.debug('Saving new activity for %s: %s', member.name, member.activity)
-
-            await self.bot.db.save_member_activity(member)
-
-    async def save_member_nickname(self, member: discord.Member):
-        """Save member nickname if it has changed"""
-        last_member_nickname = await self.bot.db.get_member_last_nickname(member)
-        if last_member_nickname != member.nick:
-            logger.debug('Saving new nickname for %s: %s', member.name, member.nick)
-            await self.bot.db.save_member_nickname(member)
+        """
+        Save all members of a guild
+
+        In low memory mode, the member list is streamed from the API in batches. Fetched
+        members have no presence, activities are then saved for the cached members only.
+        """
+
+        members = [member for member in guild.members if not member.bot]
+        if not self.low_memory:
+            await self.bot.db.sync_guild_members(guild, members, close_absent=True)
+            return
+
+        batch = []
+        load_states = True
+        async for member in guild.fetch_members(limit=None):
+            if not member.bot:
+                batch.append(member)
+
+            if len(batch) >= MEMBER_SYNC_BATCH_SIZE:
+                await self.bot.db.sync_guild_members(guild, batch, load_states=load_states,
+                                                     activities=False)
+                load_states = False
+                batch = []
+
+        if batch or load_states:
+            await self.bot.db.sync_guild_members(guild, batch, load_states=load_states,
+                                                 activities=False)
+        await self.bot.db.sync_guild_members(guild, members, load_states=False,
+                                             close_absent=True)
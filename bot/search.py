@@ -0,0 +1,146 @@
+"""
+Search cog
+Search the archived messages of a guild
+"""
+
+import datetime
+import logging
+import re
+from typing import Dict, Optional, Tuple
+
+import discord
+from discord.ext import commands
+
+PREVIEW_LENGTH = 150
+QUERY_PREVIEW_LENGTH = 100
+REPLY_MAX_LENGTH = 2000  # characters of a discord message
+# since:YYYY-MM-DD and until:YYYY-MM-DD filters in a search query
+DATE_FILTER_PATTERN = re.compile(r'(?:^|\s)(since|until):(\S+)')
+
+logger = logging.getLogger(__name__)
+
+
+class Search(commands.Cog):
+    """Full-text search in the archived messages."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        # Last search of every channel, with the id to continue it from
+        self.last_searches: Dict[int, dict] = {}
+
+    @commands.command()
+    @commands.guild_only()
+    async def search(self, ctx, member: Optional[discord.Member] = None,
+                     channel: Optional[discord.TextChannel] = None, *, query: str):
+        """
+        Search the messages of the guild, newest first
+
+        !search [member] [channel] [since:YYYY-MM-DD] [until:YYYY-MM-DD] <query>
+        Quoted phrases, "or" and -word are supported, until is inclusive
+        """
+
+        try:
+            query, since, until = self.parse_date_filters(query)
+        except ValueError:
+            await ctx.send('**Dates must be written YYYY-MM-DD**')
+            return
+
+        if not query:
+            await ctx.send('**Nothing to search**')
+            return
+
+        search = {'query': query, 'member': member, 'channel': channel,
+                  'since': since, 'until': until, 'before': None}
+        self.last_searches[ctx.channel.id] = search
+        await self.send_page(ctx, search)
+
+    @commands.command()
+    @commands.guild_only()
+    async def more(self, ctx):
+        """
+        Show the next results of the last search of the channel
+
+        !more
+        """
+
+        search = self.last_searches.get(ctx.channel.id)
+        if not search:
+            await ctx.send('**No search to continue, use !search first**')
+            return
+
+        await self.send_page(ctx, search)
+
+    async def send_page(self, ctx, search: dict) -> None:
+        """Send the results of a search after its last shown message"""
+
+        messages = await self.bot.db.search_messages(ctx.guild, search['query'],
+                                                     member=search['member'],
+                                                     channel=search['channel'],
+                                                     since=search['since'],
+                                                     until=search['until'],
+                                                     before=search['before'])
+        if messages is None:
+            await ctx.send('**Search is not available right now**')
+            return
+
+        query = search['query']
+        if len(query) > QUERY_PREVIEW_LENGTH:
+            query = query[:QUERY_PREVIEW_LENGTH] + '...'
+        query = discord.utils.escape_markdown(discord.utils.escape_mentions(query))
+
+        if not messages:
+            self.last_searches.pop(ctx.channel.id, None)
+            await ctx.send(f'**No more messages matching {query}**',
+                           allowed_mentions=discord.AllowedMentions.none())
+            return
+
+        # Results that do not fit in one reply are shown by the next !more
+        reply = f'**Messages matching {query}**'
+        last = None
+        for message in messages:
+            line = self.format_message(ctx.guild, message)
+            if len(reply) + 1 + len(line) > REPLY_MAX_LENGTH:
+                break
+            reply += '\n' + line
+            last = message
+
+        await ctx.send(reply, allowed_mentions=discord.AllowedMentions.none())
+        search['before'] = last['id']
+
+    @staticmethod
+    def parse_date_filters(query: str) -> Tuple[str, Optional[datetime.datetime],
+                                                 Optional[datetime.datetime]]:
+        """
+        Remove the since: and until: filters from a query and return them as datetimes
+
+        Raises ValueError on a malformed date.
+        """
+
+        dates = {'since': None, 'until': None}
+        for name, value in DATE_FILTER_PATTERN.findall(query):
+            dates[name] = datetime.datetime.strptime(value, '%Y-%m-%d')
+        if dates['until']:
+            dates['until'] += datetime.timedelta(days=1)
+
+        query = ' '.join(DATE_FILTER_PATTERN.sub(' ', query).split())
+        return query, dates['since'], dates['until']
+
+    @staticmethod
+    def format_message(guild: discord.Guild, message: dict) -> str:
+        """One line preview of a message with its author, channel and date"""
+
+        author = guild.get_member(message['user_id'])
+        name = discord.utils.escape_mentions(author.display_name) if author else message['user_id']
+        channel = guild.get_channel(message['channel'])
+        content = discord.utils.escape_mentions(message['content']).replace('\n', ' ')
+        if len(content) > PREVIEW_LENGTH:
+            content = content[:PREVIEW_LENGTH] + '...'
+
+        return (f'{message["datetime"]:%Y-%m-%d} '
+                f'{channel.mention if channel else message["channel"]} '
+                f'**{name}**: {content}')
+
+    @search.error
+    async def search_error(self, ctx, error):
+        """Called on error in search command"""
+        logger.error('Error in search ctx: %s, err: %s', ctx, error)
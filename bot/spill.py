@@ -0,0 +1,149 @@
+"""
+Spill log module
+Append-only log of the writes that could not reach the database, replayed once it is back
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional
+
+SEGMENT_PREFIX = 'spill-'
+SEGMENT_SUFFIX = '.jsonl'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+logger = logging.getLogger(__name__)
+
+
+def encode_datetime(value: datetime.datetime) -> str:
+    """Naive datetime as text, with microseconds"""
+    return value.strftime(DATETIME_FORMAT)
+
+
+def decode_datetime(value: str) -> datetime.datetime:
+    """Datetime written by encode_datetime"""
+    return datetime.datetime.strptime(value, DATETIME_FORMAT)
+
+
+class SpillLog:
+    """
+    Records appended as JSON lines to segment files of a directory
+
+    Records are written to the current segment right away, and fsynced in batches at most
+    `fsync_interval` seconds later. The current segment is rotated once it reaches
+    `max_segment_size` bytes, and before a replay. Replayed segments are deleted.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float, max_segment_size: int):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.max_segment_size = max_segment_size
+        self.file = None
+        self.name = None
+        self.size = 0
+        self.sync_task: Optional[asyncio.Task] = None
+
+        os.makedirs(directory, exist_ok=True)
+        # Closed segments waiting for replay, oldest first
+        self.closed: List[str] = sorted(
+            name for name in os.listdir(directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        self.next_segment = int(self.closed[-1][len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1 \
+            if self.closed else 0
+        if self.closed:
+            logger.warning('%d spill log segments to replay in %s', len(self.closed), directory)
+
+    @property
+    def pending(self) -> bool:
+        """Whether records are waiting to be replayed"""
+        return self.file is not None or bool(self.closed)
+
+    def append(self, record: dict) -> None:
+        """Append a record, it is on disk at most `fsync_interval` seconds later"""
+
+        if self.file is None:
+            self.name = f'{SEGMENT_PREFIX}{self.next_segment:010d}{SEGMENT_SUFFIX}'
+            self.next_segment += 1
+            self.file = open(os.path.join(self.directory, self.name), 'a', encoding='utf-8')
+            self.size = 0
+
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        self.file.write(line)
+        self.file.flush()
+        self.size += len(line)
+
+        if self.size >= self.max_segment_size:
+            self.rotate()
+        elif not self.sync_task:
+            self.sync_task = asyncio.ensure_future(self._sync_later())
+
+    async def _sync_later(self) -> None:
+        await asyncio.sleep(self.fsync_interval)
+        self.sync_task = None
+        if self.file is not None:
+            # The segment can be rotated and closed while the copy of its descriptor is synced
+            fd = os.dup(self.file.fileno())
+            await asyncio.get_event_loop().run_in_executor(None, self._sync_fd, fd)
+
+    @staticmethod
+    def _sync_fd(fd: int) -> None:
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def rotate(self) -> None:
+        """Sync and close the current segment, the next record starts a new one"""
+
+        if self.sync_task:
+            self.sync_task.cancel()
+            self.sync_task = None
+
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.closed.append(self.name)
+            self.file = None
+            self.name = None
+            self.size = 0
+
+    def close(self) -> None:
+        """Sync and close the current segment"""
+        self.rotate()
+
+    async def replay(self, handler: Callable[[dict], Awaitable[bool]]) -> bool:
+        """
+        Pass every record to `handler`, oldest first, and delete the replayed segments
+
+        The replay stops at the first record for which `handler` returns False, its segment
+        is replayed again from the start next time, so records must be idempotent. Return
+        whether every record was replayed.
+        """
+
+        while True:
+            self.rotate()
+            if not self.closed:
+                return True
+
+            while self.closed:
+                name = self.closed[0]
+                path = os.path.join(self.directory, name)
+                with open(path, 'r', encoding='utf-8') as segment:
+                    lines = segment.readlines()
+
+                for number, line in enumerate(lines, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line of a segment interrupted by a crash
+                        logger.error('Skipping corrupted line %d of spill segment %s',
+                                     number, name)
+                        continue
+
+                    if not await handler(record):
+                        return False
+
+                os.remove(path)
+                self.closed.pop(0)
+                logger.info('Replayed spill segment %s: %d records', name, len(lines))
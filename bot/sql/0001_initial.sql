@@ -0,0 +1,73 @@
+-- Tables used by the bot and the indexes its queries rely on
+
+CREATE SCHEMA IF NOT EXISTS staticord;
+
+CREATE TABLE IF NOT EXISTS staticord.guild (
+    id bigint PRIMARY KEY,
+    name text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS staticord.member (
+    id bigint NOT NULL,
+    guild bigint NOT NULL,
+    name text NOT NULL,
+    PRIMARY KEY (id, guild)
+);
+
+CREATE TABLE IF NOT EXISTS staticord.message (
+    id bigint PRIMARY KEY,
+    guild bigint NOT NULL,
+    channel bigint NOT NULL,
+    user_id bigint NOT NULL,
+    content text,
+    datetime timestamp NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS staticord.nickname (
+    guild bigint NOT NULL,
+    member bigint NOT NULL,
+    nickname text,
+    datetime timestamp NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS staticord.activity (
+    guild bigint NOT NULL,
+    member bigint NOT NULL,
+    status text,
+    type text,
+    name text,
+    start timestamp,
+    "end" timestamp,
+    listening_title text,
+    listening_artist text,
+    listening_album text,
+    listening_track_id text,
+    listening_party text
+);
+
+CREATE TABLE IF NOT EXISTS staticord.member_emoji (
+    guild bigint NOT NULL,
+    member bigint NOT NULL,
+    emoji text NOT NULL,
+    PRIMARY KEY (guild, member)
+);
+
+-- CHANNEL_LAST_MESSAGE_DATE_SQL
+CREATE INDEX IF NOT EXISTS message_channel_datetime_idx
+    ON staticord.message (channel, datetime);
+
+-- GUILD_MESSAGE_ID_RANGE_SQL, RANDOM_MESSAGES
+CREATE INDEX IF NOT EXISTS message_guild_id_idx
+    ON staticord.message (guild, id);
+
+-- GUILD_LAST_NICKNAMES_SQL
+CREATE INDEX IF NOT EXISTS nickname_guild_member_datetime_idx
+    ON staticord.nickname (guild, member, datetime DESC);
+
+-- GUILD_LAST_ACTIVITIES_SQL
+CREATE INDEX IF NOT EXISTS activity_guild_member_start_idx
+    ON staticord.activity (guild, member, start DESC);
+
+-- RANDOM_MESSAGES
+CREATE INDEX IF NOT EXISTS member_emoji_member_idx
+    ON staticord.member_emoji (member);
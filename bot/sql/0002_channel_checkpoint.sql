@@ -0,0 +1,16 @@
+-- Last message saved by the history backfill of every channel
+
+CREATE TABLE IF NOT EXISTS staticord.channel_checkpoint (
+    channel bigint PRIMARY KEY,
+    guild bigint NOT NULL,
+    last_message bigint NOT NULL
+);
+
+INSERT INTO staticord.channel_checkpoint (channel, guild, last_message)
+    SELECT channel, max(guild), max(id)
+    FROM staticord.message
+    GROUP BY channel
+ON CONFLICT (channel) DO NOTHING;
+
+-- Backfill resumed by date used it, the checkpoint replaces it
+DROP INDEX IF EXISTS staticord.message_channel_datetime_idx;
@@ -0,0 +1,14 @@
+-- Activities are stored as intervals: a row is opened when a member starts an activity and its
+-- "end" is set when the activity of the member changes
+
+ALTER TABLE staticord.activity ADD COLUMN IF NOT EXISTS id bigserial PRIMARY KEY;
+
+-- Snapshot rows saved before end where each following snapshot of the member starts
+UPDATE staticord.activity
+    SET "end" = next.start
+    FROM (
+        SELECT id, lead(start) OVER (PARTITION BY guild, member ORDER BY start, id) AS start
+        FROM staticord.activity
+    ) next
+    WHERE activity.id = next.id
+        AND next.start IS NOT NULL;
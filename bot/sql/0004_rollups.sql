@@ -0,0 +1,48 @@
+-- Daily rollups maintained by the bot as messages and activities are saved
+
+CREATE TABLE IF NOT EXISTS staticord.message_daily (
+    guild bigint NOT NULL,
+    member bigint NOT NULL,
+    channel bigint NOT NULL,
+    day date NOT NULL,
+    messages integer NOT NULL,
+    PRIMARY KEY (guild, member, channel, day)
+);
+
+CREATE INDEX IF NOT EXISTS message_daily_guild_day_idx
+    ON staticord.message_daily (guild, day);
+
+-- Activities are rolled up by type and name, the artist for spotify
+CREATE TABLE IF NOT EXISTS staticord.activity_daily (
+    guild bigint NOT NULL,
+    member bigint NOT NULL,
+    type text NOT NULL,
+    name text NOT NULL,
+    day date NOT NULL,
+    seconds double precision NOT NULL,
+    PRIMARY KEY (guild, member, type, name, day)
+);
+
+CREATE INDEX IF NOT EXISTS activity_daily_guild_day_idx
+    ON staticord.activity_daily (guild, day);
+
+-- Open intervals are added to the rollups when stats are read
+CREATE INDEX IF NOT EXISTS activity_open_idx
+    ON staticord.activity (guild, member)
+    WHERE "end" IS NULL;
+
+INSERT INTO staticord.message_daily (guild, member, channel, day, messages)
+    SELECT guild, user_id, channel, datetime::date, count(*)
+    FROM staticord.message
+    GROUP BY guild, user_id, channel, datetime::date
+ON CONFLICT DO NOTHING;
+
+INSERT INTO staticord.activity_daily (guild, member, type, name, day, seconds)
+    SELECT guild, member, type, coalesce(listening_artist, name, ''), day::date,
+           sum(extract(epoch FROM least("end", day + interval '1 day') - greatest(start, day)))
+    FROM staticord.activity,
+         generate_series(date_trunc('day', start), "end", interval '1 day') AS day
+    WHERE type IS NOT NULL
+        AND "end" IS NOT NULL
+    GROUP BY guild, member, type, coalesce(listening_artist, name, ''), day::date
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,4 @@
+-- Guild exports stream activities in id order
+
+CREATE INDEX IF NOT EXISTS activity_guild_id_idx
+    ON staticord.activity (guild, id);
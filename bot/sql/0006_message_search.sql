@@ -0,0 +1,9 @@
+-- Full-text search on message contents
+-- The 'simple' configuration does not stem words, messages are in several languages
+
+ALTER TABLE staticord.message
+    ADD COLUMN IF NOT EXISTS search tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS message_search_idx
+    ON staticord.message USING gin (search);
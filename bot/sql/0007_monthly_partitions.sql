@@ -0,0 +1,150 @@
+-- Monthly range partitions: messages by snowflake id, activities by start
+-- The existing tables become the legacy partitions of everything up to the end of the current
+-- month, the retention removes them once all of that range is old enough. The bot creates the
+-- partitions of the next months ahead of time with create_month_partition. Rows outside of
+-- every partition go to the default partitions.
+
+-- First snowflake id of a UTC timestamp
+CREATE OR REPLACE FUNCTION staticord.snowflake(ts timestamp) RETURNS bigint
+    LANGUAGE sql IMMUTABLE AS $$
+    SELECT ((extract(epoch FROM ts) * 1000)::bigint - 1420070400000) << 22
+$$;
+
+-- Messages
+
+ALTER TABLE staticord.message RENAME TO message_legacy;
+ALTER INDEX staticord.message_pkey RENAME TO message_legacy_pkey;
+ALTER INDEX staticord.message_guild_id_idx RENAME TO message_legacy_guild_id_idx;
+ALTER INDEX staticord.message_search_idx RENAME TO message_legacy_search_idx;
+
+CREATE TABLE staticord.message (
+    LIKE staticord.message_legacy INCLUDING DEFAULTS INCLUDING GENERATED,
+    PRIMARY KEY (id)
+) PARTITION BY RANGE (id);
+
+CREATE INDEX message_guild_id_idx
+    ON staticord.message (guild, id);
+
+CREATE INDEX message_search_idx
+    ON staticord.message USING gin (search);
+
+CREATE TABLE staticord.message_default PARTITION OF staticord.message DEFAULT;
+
+-- Activities, the primary key includes the partition key
+
+-- Snapshots without a start start where the previous snapshot of the member ended, or else
+-- where the next one starts. Their duration is unknown, the open ones are closed right away.
+UPDATE staticord.activity
+    SET start = least(neighbour.start, activity."end"),
+        "end" = coalesce(activity."end", neighbour.start)
+    FROM (
+        SELECT id, coalesce(lag("end") OVER member_order, lead(start) OVER member_order, "end")
+            AS start
+        FROM staticord.activity
+        WINDOW member_order AS (PARTITION BY guild, member ORDER BY id)
+    ) neighbour
+    WHERE activity.id = neighbour.id
+        AND activity.start IS NULL
+        AND neighbour.start IS NOT NULL;
+
+-- The ones that still cannot be placed in any month are kept aside
+CREATE TABLE staticord.activity_unplaced AS
+    SELECT * FROM staticord.activity WHERE start IS NULL;
+
+DELETE FROM staticord.activity WHERE start IS NULL;
+
+ALTER TABLE staticord.activity RENAME TO activity_legacy;
+ALTER TABLE staticord.activity_legacy DROP CONSTRAINT activity_pkey;
+ALTER TABLE staticord.activity_legacy ALTER COLUMN start SET NOT NULL;
+ALTER INDEX staticord.activity_guild_member_start_idx
+    RENAME TO activity_legacy_guild_member_start_idx;
+ALTER INDEX staticord.activity_open_idx RENAME TO activity_legacy_open_idx;
+ALTER INDEX staticord.activity_guild_id_idx RENAME TO activity_legacy_guild_id_idx;
+
+CREATE TABLE staticord.activity (
+    LIKE staticord.activity_legacy INCLUDING DEFAULTS,
+    PRIMARY KEY (id, start)
+) PARTITION BY RANGE (start);
+
+ALTER SEQUENCE staticord.activity_id_seq OWNED BY staticord.activity.id;
+
+CREATE INDEX activity_guild_member_start_idx
+    ON staticord.activity (guild, member, start DESC);
+
+CREATE INDEX activity_open_idx
+    ON staticord.activity (guild, member)
+    WHERE "end" IS NULL;
+
+CREATE INDEX activity_guild_id_idx
+    ON staticord.activity (guild, id);
+
+CREATE TABLE staticord.activity_default PARTITION OF staticord.activity DEFAULT;
+
+DO $$
+DECLARE
+    next_month timestamp := date_trunc('month', now() AT TIME ZONE 'utc') + interval '1 month';
+BEGIN
+    EXECUTE format('ALTER TABLE staticord.message ATTACH PARTITION staticord.message_legacy '
+                   'FOR VALUES FROM (MINVALUE) TO (%s)', staticord.snowflake(next_month));
+    EXECUTE format('ALTER TABLE staticord.activity ATTACH PARTITION staticord.activity_legacy '
+                   'FOR VALUES FROM (MINVALUE) TO (%L)', next_month);
+END
+$$;
+
+-- Create the partition of a month of message or activity, return whether it was created.
+-- Rows of the month already in the default partition are moved to the new partition. Months
+-- covered by another partition, like the legacy ones, are skipped.
+CREATE OR REPLACE FUNCTION staticord.create_month_partition(parent text, month date)
+    RETURNS boolean
+    LANGUAGE plpgsql AS $$
+DECLARE
+    partition text := format('%s_%s', parent, to_char(month, 'YYYY_MM'));
+    key text;
+    lower_bound text;
+    upper_bound text;
+    columns text;
+BEGIN
+    IF to_regclass(format('staticord.%I', partition)) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+
+    IF parent = 'message' THEN
+        key := 'id';
+        lower_bound := staticord.snowflake(month);
+        upper_bound := staticord.snowflake(month + interval '1 month');
+    ELSIF parent = 'activity' THEN
+        key := 'start';
+        lower_bound := quote_literal(month::timestamp);
+        upper_bound := quote_literal(month + interval '1 month');
+    ELSE
+        RAISE EXCEPTION '% is not a partitioned table', parent;
+    END IF;
+
+    -- Generated columns are computed again by the insert
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+        FROM pg_attribute
+        WHERE attrelid = format('staticord.%I', parent)::regclass
+            AND attnum > 0
+            AND NOT attisdropped
+            AND attgenerated = '';
+
+    EXECUTE format('CREATE TABLE staticord.%I (LIKE staticord.%I INCLUDING DEFAULTS '
+                   'INCLUDING GENERATED)', partition, parent);
+    EXECUTE format('WITH moved AS (DELETE FROM staticord.%I WHERE %I >= %s AND %I < %s '
+                   'RETURNING %s) INSERT INTO staticord.%I (%s) SELECT %s FROM moved',
+                   parent || '_default', key, lower_bound, key, upper_bound, columns,
+                   partition, columns, columns);
+
+    BEGIN
+        EXECUTE format('ALTER TABLE staticord.%I ATTACH PARTITION staticord.%I '
+                       'FOR VALUES FROM (%s) TO (%s)', parent, partition, lower_bound,
+                       upper_bound);
+    EXCEPTION WHEN invalid_object_definition THEN
+        -- Overlaps an existing partition, no row of the month was in the default one
+        EXECUTE format('DROP TABLE staticord.%I', partition);
+        RETURN false;
+    END;
+
+    RETURN true;
+END
+$$;
@@ -0,0 +1,89 @@
+"""
+Stats cog
+Answer message and activity statistics from the daily rollups
+"""
+
+import datetime
+import logging
+from typing import Optional
+
+import discord
+from discord.ext import commands
+
+DEFAULT_DAYS = 30
+TOP_SIZE = 5
+
+logger = logging.getLogger(__name__)
+
+
+def format_duration(seconds: float) -> str:
+    """Duration as hours and minutes"""
+
+    minutes = int(seconds // 60)
+    return f'{minutes // 60}h{minutes % 60:02d}'
+
+
+class Stats(commands.Cog):
+    """Messages and activities statistics."""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command()
+    @commands.guild_only()
+    async def stats(self, ctx, member: Optional[discord.Member] = None,
+                    days: int = DEFAULT_DAYS):
+        """
+        Show the statistics of the guild, or of a member, over the last days
+
+        !stats [member] [days]
+        """
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+        if member:
+            stats = await self.bot.db.get_member_stats(member, since, TOP_SIZE)
+        else:
+            stats = await self.bot.db.get_guild_stats(ctx.guild, since, TOP_SIZE)
+
+        if stats is None:
+            await ctx.send('**Stats are not available right now**')
+            return
+
+        if member:
+            title = f'**Stats of {member.display_name} ({days} days)**'
+            message_lines = [f'{self.channel_name(ctx.guild, r["channel"])}: {r["messages"]}'
+                             for r in stats['messages']]
+        else:
+            title = f'**Stats of {ctx.guild.name} ({days} days)**'
+            message_lines = [f'{self.member_name(ctx.guild, r["member"])}: {r["messages"]}'
+                             for r in stats['messages']]
+
+        activity_lines = [f'{r["name"] or r["type"]} ({r["type"]}): '
+                          f'{format_duration(r["seconds"])}' for r in stats['activities']]
+
+        await ctx.send(f'{title}'
+                       f'\n**-------------------------------------------**'
+                       f'\n**Messages**'
+                       f'\n' + ('\n'.join(message_lines) or '-') +
+                       f'\n**Activities**'
+                       f'\n' + ('\n'.join(activity_lines) or '-'))
+
+    @staticmethod
+    def channel_name(guild: discord.Guild, channel_id: int) -> str:
+        """Mention of a channel, or its id if it does not exist anymore"""
+
+        channel = guild.get_channel(channel_id)
+        return channel.mention if channel else str(channel_id)
+
+    @staticmethod
+    def member_name(guild: discord.Guild, member_id: int) -> str:
+        """Display name of a member, or its id if it left the guild"""
+
+        member = guild.get_member(member_id)
+        return member.display_name if member else str(member_id)
+
+    @stats.error
+    async def stats_error(self, ctx, error):
+        """Called on error in stats command"""
+        logger.error('Error in stats ctx: %s, err: %s', ctx, error)